@@ -3,6 +3,7 @@ from utils.utils import check_protocol, unify_pcaps
 from utils.utils import main_help
 from utils.completer import IMCompleter
 from terminaltables import AsciiTable
+from prompt_toolkit.shortcuts import ProgressBar
 
 from scapy.layers.dot15d4 import *
 from scapy.layers.zigbee import *
@@ -11,6 +12,7 @@ from scapy.utils import *
 
 import subprocess
 import os
+import re
 
 @cls_commands
 class Database:
@@ -24,17 +26,21 @@ class Database:
         self.dbc = dbController
         
     @command
-    def importPcaps(self, pcap: list, protocol: list, output: str, thread: int, nodesFile: str=None):
+    def importPcaps(self, pcap: list, protocol: list, output: str, thread: int, nodesFile: str=None, chunk: int=None, key: list=None, batch: int=None):
         """
         Import the pcap file into the database
 
-        Usage: importPcaps (<protocol> <pcap>)... [--output <filename>] [--thread <nbThread>] [--nodesFile <nodesFile>] 
+        Usage: importPcaps (<protocol> <pcap>)... [--output <filename>] [--thread <nbThread>] [--nodesFile <nodesFile>] [--chunk <chunkSize>] [--key <key>]... [--batch <batchSize>]
 
         Options:
             -h, --help                   Print this message.
             -o, --output <filename>      Output file to store the result.
             -t, --thread <nbThread>      Thread number to use [default: 1].
             -n, --nodesFile <nodesFile>  File that contains a list of nodes used in communications. 
+            -c, --chunk <chunkSize>      Number of packets sent at once to each thread [default: 1000].
+            -k, --key <key>              ZigBee network key (hexadecimal). Several keys can be given for
+                                         captures of several networks or with key rotations.
+            -b, --batch <batchSize>      Number of transmissions written at once in the database [default: 10000].
         
         Arguments:
             protocol                   Name of the IoT protocol. 
@@ -44,13 +50,31 @@ class Database:
             import_pcap zigbee file1.pcap zigbee file2.pcap os4i file3.pcap --thread 2 -o zigbee-os4i.csv
             import_pcap btle file1.pcap os4i file3.pcap -t 2 -o btle-os4i.csv
             import_pcap os4i file.pcap --thread 3 --debug --output os4i.csv
+            import_pcap zigbee big-capture.pcapng --thread 4 --chunk 10000 -o zigbee.csv
+            import_pcap zigbee site1.pcap zigbee site2.pcap -k f247868f650fa30e2f0d5e1abc341179 -k 000102030405060708090a0b0c0d0e0f -o zigbee.csv
         """
         print(f"[i] Pcaps: {pcap}\nProtocols: {protocol}\nOutput: {output}\nThread: {thread}")
+        for k in key or []:
+            if not re.fullmatch('[0-9a-fA-F]{32}', k):
+                print(f"[e] {k} is not a valid ZigBee network key (32 hexadecimal characters)")
+                return
+
         if check_protocol(protocol):
             try:
                 pcaps_list = unify_pcaps(protocol, pcap)
                 print(f"[i] Pcaps_list: {pcaps_list}\nOutput: {output}\nThread: {thread}")
-                self.dbc.update(pcaps_list, output, thread, nodesFile)
+                
+                # One counter per pcap, updated each time a chunk is converted
+                with ProgressBar(title='Converting pcaps (packets processed)') as pb:
+                    counters = {}
+                    def progress(i, pcap, nbFrames, done):
+                        if i not in counters:
+                            counters[i] = pb(label=os.path.basename(pcap))
+                        counters[i].items_completed = nbFrames
+                        counters[i].done = done
+                        pb.invalidate()
+
+                    self.dbc.update(pcaps_list, output, thread, nodesFile, chunk, progress, key, batch)
 
             except FileNotFoundError:
                 print("File not found")
@@ -162,6 +186,32 @@ class Database:
 
         print(ret)
 
+    @command
+    def checkSchema(self):
+        """
+        Create the missing indexes and constraints and check that the queries use them
+
+        Usage: checkSchema [-h]
+
+        Options:
+            -h, --help             Print this message.
+        """
+
+        report = self.dbc.checkSchema()
+
+        table_data = [["lookup", "index", "plan"]]
+        for name, ok, operators in report:
+            table_data.append([name, "yes" if ok else "MISSING", ', '.join(operators)])
+
+        table = AsciiTable(table_data)
+        table.inner_column_border = False
+        table.inner_footing_row_border = False
+        table.inner_heading_row_border = True
+        table.inner_row_border = False
+        table.outer_border = False
+
+        print(f"{table.table}")
+
     # List all nodes stored in the database
     @command
     def getNodes(self):
@@ -5,13 +5,15 @@ import subprocess
 import logging
 import functools
 from utils.utils import readNodesFile 
-from utils.buildNode import createNode
+from utils.buildNode import createNode, functions as nodeBuilders
 from database.nodesdatabase import NodesDatabase
+from database.memorydatabase import MemoryDatabase
+from database.gridsearch import grid_search
 from neo4j import GraphDatabase
 from shlex import split
 from docopt import docopt, DocoptExit
 
-from sniffer.gen_packet import gen_packet
+from sniffer.gen_packet import gen_packets
 
 # def setNodeProperties(nameID, dlsrc, nwksrc, label, role):
 #     properties = {
@@ -40,10 +42,36 @@ from sniffer.gen_packet import gen_packet
 #     'n13': setNodeProperties(12, ['00:12:4b:00:12:04:ce:a4', '00:12:4b:00:12:04:ce'], ['::212:4b00:1204:cea4', 'fe80::212:4b:00:12:04:ce', 'fd00::212:4b00:1204:cea4'], 2, []),
 # }
 
+# Backends where the graphs are stored. They all provide the methods of
+# NodesDatabase used below and give the same results.
+# 'memory' builds the graphs without a neo4j server, they are lost on exit.
+backends = {
+    #'neo4j': lambda: NodesDatabase("bolt:http://localhost:7474", "neo4j", "spliot"), # or port 7474
+    'neo4j': lambda: NodesDatabase("bolt:http://localhost:7687", "neo4j", "iotmap"), # or port 7474
+    'memory': MemoryDatabase
+}
+
 class DBController(object):
-    def __init__(self):
-        #self.db = NodesDatabase("bolt:http://localhost:7474", "neo4j", "spliot") # or port 7474
-        self.db = NodesDatabase("bolt:http://localhost:7687", "neo4j", "iotmap") # or port 7474
+    def __init__(self, backend='neo4j'):
+        if backend not in backends:
+            raise ValueError(f"Unknown backend '{backend}', available backends: {', '.join(backends)}")
+        self.backend = backend
+        self.db = backends[backend]()
+        self.bootstrap()
+
+    # Create the indexes and constraints of the database if they are missing
+    # The controller can be created before the database is up, the schema is
+    # then created by the next call
+    def bootstrap(self):
+        try:
+            return self.db.bootstrap()
+        except Exception as e:
+            logging.error(f"[e] Unable to create the database schema: {e}")
+            return None
+
+    def checkSchema(self):
+        self.bootstrap()
+        return self.db.check_schema()
 
     # Return a dictionnary of TX transmissions
     def loadCSV(self, csvfile):
@@ -105,14 +133,14 @@ class DBController(object):
     # Then use the result to create the nodes and the transmission
     # TODO: Currently the nodes properties are hardcoded but a function will
     # arrive to extract each address from the pcap and provide the set of nodes
-    def update(self, pcaps_list, output, nbThread, nodesFile):
-        csvData = []
-        for protocol in pcaps_list.keys():
-            for pcap in pcaps_list[protocol]:
-                csvData += gen_packet(pcap, protocol.upper(), nbThread, True)
-
-        # Let order the list by timestamp
-        csvData.sort(key=lambda x: x[1])
+    # All pcaps are converted at the same time in a single pool of nbThread
+    # processes, by chunks of chunkSize packets. progress is called each time
+    # a chunk is converted (see gen_packets_stream). keys is the list of
+    # ZigBee network keys used to decrypt the ZigBee pcaps.
+    # Transmissions are written in the database by batches of batchSize rows
+    def update(self, pcaps_list, output, nbThread, nodesFile, chunkSize=None, progress=None, keys=None, batchSize=None):
+        # Rows are ordered by timestamp and written as soon as they are merged
+        csvData = gen_packets(pcaps_list, nbThread, True, chunkSize, progress, keys)
 
         try:
             logging.info(f"[i] Writting into {output} file")
@@ -129,20 +157,28 @@ class DBController(object):
             #print(f"CSVFile: {csvData}")
             logging.error(f'Error while writting into CSV file...\n{csve}')
             return False
+        except ValueError as ve:
+            logging.error(f'Error while ordering the rows...\n{ve}')
+            return False
         except :
             #print(f"CSVFile: {csvData}")
             logging.error(f'Error while writting into CSV file...')
             return False
 
+        # The rows are read back from the unified file,
+        # like dlGraph does when a csvFile is given
         if nodesFile is None:
-            nodes = self.extractNodes(csvData)
+            with open(output, 'r') as csvFile:
+                nodes = self.extractNodes(csv.reader(csvFile, delimiter=','))
             self.db.create_nodes(nodes)
         else:
             nodes = readNodesFile(nodesFile)
             self.importNodes(nodes)          
             
-        nodesTx = self.loadCSV(csvData)
-        self.db.create_nodesTX(nodesTx)
+        with open(output, 'r') as csvFile:
+            nodesTx = self.loadCSV(csv.reader(csvFile, delimiter=','))
+        self.db.create_nodesTX(nodesTx, batchSize)
+        self.markTransmissions(nodesTx)
         return True
 
 
@@ -161,6 +197,7 @@ class DBController(object):
             nodesTx = self.loadCSV(csvData)
             #self.db.create_nodes(nodes)
             self.db.create_nodesTX(nodesTx)
+            self.markTransmissions(nodesTx)
 
             return True
         # Check if transmissions are not already stored in the database
@@ -180,11 +217,14 @@ class DBController(object):
             self.delNodes(3, 'visu')
             
         self.db.nwkGraph()
+        self.markLayer(3)
 
 
     # This function builds the transport graph (Role of the nodes in the network)
     # Build the dlGraph and the nwkGraph if they do not exist
-    def transGraph(self, delta, delta2, filename):
+    # The transmissions forwarded by the controllers are written in controllersFile
+    # if it is provided
+    def transGraph(self, delta, delta2, filename, controllersFile=None):
         # If filename is provided then we erase the database and
         # use the content of the file as data
         if filename is not None:
@@ -196,21 +236,136 @@ class DBController(object):
         if delta2 is not None and delta2 < 0.:
             delta2 = None
 
-        ret = self.db.transGraph(delta, delta2)
+        ret = self.db.transGraph(delta, delta2, controllersFile)
+        self.markLayer(4)
         return ret
 
+    # Build the transport graph without controllers and return the transmissions
+    # a controller can forward with their delay (see layers.controller_thresholds)
+    # A transmission is returned by transGraph(delta, delta2, None) for any
+    # delta2 greater than its delay
+    def controllerThresholds(self, delta, maxDelta):
+        self.transGraph(delta, None, None)
+        return self.db.controllerThresholds(maxDelta)
+
+    # Evaluate all combinations of the deltas against the expected results,
+    # in nbThread processes working on copies of the current network graph
+    # Return a list of (tdelta1, tdelta2, adelta, precision, recall)
+    def gridSearch(self, expectedResult, tdeltas1, tdeltas2, adeltas, nbThread=1, progress=None):
+        snapshot = self.db.nwkSnapshot()
+        return grid_search(snapshot, expectedResult, tdeltas1, tdeltas2, adeltas, nbThread, progress)
+
     # This function builds the application graph (Currently only Interaction pattern)
     # Build the 3 previous graphs if they do not exist
-    def appGraph(self, delta, tdelta1, tdelta2, filename):
+    # maxHops bounds the length of the paths between a source and a sink
+    def appGraph(self, delta, tdelta1, tdelta2, filename, controllersFile=None, maxHops=None):
         # If filename is provided then we erase the database and
         # use the content of the file as data
         if filename is not None:
-            self.transGraph(tdelta1, tdelta2, filename)
+            self.transGraph(tdelta1, tdelta2, filename, controllersFile)
         # Check if trans transmissions are not already stored in the database
         else:
             self.delNodes(5, 'node')
             
-        self.db.appGraph(delta)
+        self.db.appGraph(delta, maxHops)
+        self.markLayer(5)
+
+    # Append the transmissions of a file at the unified format (or a list of
+    # its rows) to the graphs already built, without deleting the upper layers.
+    # Each layer has a watermark, the timestamp of the last transmission it
+    # processed: only the rows after the watermark of the dl graph are imported
+    # (rows with the same timestamp are considered already imported), then only
+    # the pairs of nodes with new transmissions are processed again by the
+    # transport graph and only the sources with a path to the updated nodes by
+    # the application graph. The layers that are not built are not updated.
+    # The deltas must be the ones used to build the graphs.
+    # Return the watermarks of the layers
+    def appendGraph(self, data, tdelta1, tdelta2, adelta, maxHops=None):
+        if isinstance(data, str):
+            with open(data, 'r') as csvFile:
+                data = list(csv.reader(csvFile, delimiter=','))
+
+        marks = self.db.watermarks()
+        if 2 not in marks:
+            logging.warning("[w] The dl graph has no watermark, it must be built with dlGraph first")
+            return marks
+
+        nodesTx = self.loadCSV(data)
+        if nodesTx is None:
+            return marks
+        nodesTx = {key: properties for key, properties in nodesTx.items() if properties['timestamp'] > marks[2]}
+        if not nodesTx:
+            logging.info("[i] No new transmission to append")
+            return marks
+
+        self.db.create_nodesTX(nodesTx, visu=False)
+        last = self.markTransmissions(nodesTx)
+
+        changed = set()
+        if 3 in marks:
+            self.db.nwkAppend(marks[3])
+            self.db.set_watermark(3, last)
+
+            if 4 in marks:
+                if tdelta2 is not None and tdelta2 < 0.:
+                    tdelta2 = None
+                changed = self.db.transAppend(marks[4], tdelta1, tdelta2)
+                self.db.set_watermark(4, last)
+
+                if 5 in marks:
+                    self.db.appAppend(changed, adelta, maxHops)
+                    self.db.set_watermark(5, last)
+
+        logging.info(f"[i] {len(nodesTx)} transmissions appended, {len(changed)} nodes of the transport graph updated")
+        return self.db.watermarks()
+
+    # Start empty graphs up to the layer of level (see Modelling.run), they
+    # are then only built by appendGraph
+    def initGraph(self, level):
+        self.delNodes(3, 'node')
+        self.delNodes(2, 'visu')
+        self.db.removeTX(2)
+        for label in range(2, level + 2):
+            self.db.set_watermark(label, 0.)
+
+    # Create the nodes of the dl addresses of the rows that are not known yet
+    # (see extractNodes), they are numbered after the last node
+    # Only the protocols with a node builder are handled
+    def appendNodes(self, rows):
+        known = set(dl for node in self.getNodes() for dl in node[1])
+        rows = [line for line in rows if line[0] in nodeBuilders]
+        nodes = [node for node in self.extractNodes(rows) if node[1].split(';')[0] not in known]
+        if not nodes:
+            return []
+
+        last = self.maxID()[0] or 0
+        for i, node in enumerate(nodes):
+            node[0] = last + i + 1
+        self.db.create_nodes(nodes)
+        logging.info(f"[i] {len(nodes)} new nodes")
+
+        return nodes
+
+    # The watermark of the dl graph is the timestamp of its last transmission
+    def markTransmissions(self, nodesTx):
+        timestamps = [properties['timestamp'] for properties in nodesTx.values()]
+        marks = self.db.watermarks()
+        if 2 in marks:
+            timestamps.append(marks[2])
+        if not timestamps:
+            return None
+
+        self.db.set_watermark(2, max(timestamps))
+        return max(timestamps)
+
+    # A layer built from the whole layer below has the same watermark
+    def markLayer(self, label):
+        marks = self.db.watermarks()
+        if label - 1 in marks:
+            self.db.set_watermark(label, marks[label - 1])
+
+    def watermarks(self):
+        return self.db.watermarks()
 
         
     def delNodes(self, label, mode):
@@ -225,14 +380,14 @@ class DBController(object):
     # We use a protocol-specific function to create a node based on its dl address
     def extractNodes(self, csvData):
         nodes = []
+        # Nodes already found, to avoid a scan of the list for each line
+        seen = set()
         for line in csvData:
             protocol, dlsrc, dldst = line[0], line[2], line[3]
-            n1 = createNode(protocol, dlsrc)
-            n2 = createNode(protocol, dldst)
-            if n1 not in nodes:
-                nodes.append(n1)
-            if n2 not in nodes:
-                nodes.append(n2)
+            for n in (createNode(protocol, dlsrc), createNode(protocol, dldst)):
+                if tuple(n) not in seen:
+                    seen.add(tuple(n))
+                    nodes.append(n)
         nodesTocreate = []
         i = 1
         for n in nodes:
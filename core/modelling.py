@@ -1,6 +1,6 @@
 from utils.utils import command, cls_commands
 from utils.utils import main_help, convert_str_to_array, compare2arrays
-from utils.generateResults import get_optimal_delta, plot_controller_delta
+from utils.generateResults import get_optimal_delta, plot_controller_delta, calibrate_controller_delta, plot_grid_search
 from utils.completer import IMCompleter
 from terminaltables import AsciiTable
 import csv
@@ -17,6 +17,14 @@ from numpy import arange
 # from scapy.layers.sixlowpan import *
 # from scapy.utils import *
 
+# Values of a delta given as start:end:step (end excluded) or v1,v2,...
+def parse_values(values):
+    if ':' in values:
+        start, end, step = (float(v) for v in values.split(':'))
+        return [d.item() for d in arange(start, end, step)]
+
+    return [float(v) for v in values.split(',')]
+
 @cls_commands
 class Modelling:
     def __init__(self, prompt_session, dbController, options):
@@ -59,6 +67,18 @@ class Modelling:
                 'Require': False,
                 'Description': 'Delay for a controller to forward a packet. This value is used to build the application graph.',
                 'type': float
+            },
+            'controllersFile': {
+                'Current Settings': None,
+                'Require': False,
+                'Description': 'File where the transmissions forwarded by the controllers are written (e.g. tests/controller-legit.txt).',
+                'type': str
+            },
+            'maxHops': {
+                'Current Settings': None,
+                'Require': False,
+                'Description': 'Maximum number of edges between a source and a sink in the application graph (no limit if not set).',
+                'type': int
             }
         }
 
@@ -223,36 +243,38 @@ For more information about any commands hit :
         self.dbc.nwkGraph(filename)
 
     @command
-    def transGraph(self, delta: float, delta2: float,  filename:str=None):
+    def transGraph(self, delta: float, delta2: float,  filename:str=None, controllers:str=None):
         """TransGraph
         Generate the network graph of the modelling. If uppers layers have already been generated, this function
         deletes all upper layers. 
 
-        Usage: transGraph [-h] [--delta <delta1>] [--delta2 <delta2>] [--filename <filename>]
+        Usage: transGraph [-h] [--delta <delta1>] [--delta2 <delta2>] [--filename <filename>] [--controllers <controllers>]
 
         Options:
-            -h, --help               Print this help menu.
-            -d, --delta delta1       Delta1 is the delay for an object to respond to a request [Default: 0.6].
-            -e, --delta2 delta2      Delta2 is the delay for an object to forward a packet [Default: 0.7].
-            -f, --filename filename  File with packets at unified format to generate the graph.
+            -h, --help                       Print this help menu.
+            -d, --delta delta1               Delta1 is the delay for an object to respond to a request [Default: 0.6].
+            -e, --delta2 delta2              Delta2 is the delay for an object to forward a packet [Default: 0.7].
+            -f, --filename filename          File with packets at unified format to generate the graph.
+            -c, --controllers <controllers>  File where the transmissions forwarded by the controllers are written.
         """
 
         # TODO: make a file checking
         # Check if the file is correctly formed
-        self.dbc.transGraph(delta, delta2, filename)
+        self.dbc.transGraph(delta, delta2, filename, controllers)
 
     @command
-    def appGraph(self, delta: float, filename:str=None):
+    def appGraph(self, delta: float, filename:str=None, maxHops:int=None):
         """AppGraph
         Generate the network graph of the modelling. If uppers layers have already been generated, this function
         deletes all upper layers. 
 
-        Usage: appGraph [-h] [--delta <delta>] [--filename <filename>]
+        Usage: appGraph [-h] [--delta <delta>] [--filename <filename>] [--maxHops <maxHops>]
 
         Options:
             -h, --help               Print this help menu.
             -d, --delta delta        Delta is the delay for a controller to forward a packet [Default: 1.5].
             -f, --filename filename  File with packets at unified format to generate the graph.
+            -m, --maxHops <maxHops>  Maximum number of edges between a source and a sink (no limit by default).
 
         Remarks:
             If you use the --filename options, IoTMap gonna uses the tdelta1 and tdelta2 values defined in 
@@ -265,23 +287,62 @@ For more information about any commands hit :
         # Check if the file is correctly formed
         tdelta = self.options['tdelta1']['Current Settings']
         tdelta2 = self.options['tdelta2']['Current Settings']
-        self.dbc.appGraph(delta, tdelta, tdelta2, filename)
+        controllersFile = self.options['controllersFile']['Current Settings']
+        self.dbc.appGraph(delta, tdelta, tdelta2, filename, controllersFile, maxHops)
+
+    @command
+    def appendGraph(self, filename:str):
+        """AppendGraph
+        Append the packets of a file to the graphs already built, without deleting the upper layers. Only the
+        packets after the last one of the dl graph are imported, and only the nodes with new communications
+        are updated in the upper layers.
+
+        Usage: appendGraph [-h] (--filename <filename>)
+
+        Options:
+            -h, --help                 Print this help menu.
+            -f, --filename <filename>  File with packets at unified format to append.
+
+        Remarks:
+            IoTMap uses the tdelta1, tdelta2, adelta and maxHops values defined in options, they must be
+            the ones used to build the graphs.
+            To display those values use the option command: "IoTMap modelling > option".
+        """
+        marks = self.dbc.appendGraph(filename,
+                                     self.options['tdelta1']['Current Settings'],
+                                     self.options['tdelta2']['Current Settings'],
+                                     self.options['adelta']['Current Settings'],
+                                     self.options['maxHops']['Current Settings'])
+
+        table_data = [["Layer", "Last transmission"]]
+        for label, timestamp in sorted(marks.items()):
+            table_data.append([label, timestamp])
+
+        table = AsciiTable(table_data)
+        table.inner_column_border = False
+        table.inner_footing_row_border = False
+        table.inner_heading_row_border = True
+        table.inner_row_border = False
+        table.outer_border = False
+
+        print(f"{table.table}\n")
 
     @command
-    def compareTo(self, filename:str, dstart:float, dend:float, dstep:float, output:str):
+    def compareTo(self, filename:str, dstart:float, dend:float, dstep:float, output:str, rebuild:bool=False):
         """CompareTo
         Compare the result of the current run of the modelling (with the level you want) and a file 
         that contains expected results.
         This function returns the difference between the expected result and the current run of the modelling
 
         Usage: compareTo [-h] (--filename <filename>) (delta <dstart> <dend> <dstep>) 
-                         [--output <output>]
+                         [--output <output>] [--rebuild]
 
         Options:
             -h, --help                 Print this help menu.
             -l, --level level          Set the number of layers of the graph [Default: 4].
             -f, --filename <filename>  Csv File containing expected results to compare with.
             -o, --output <output>      File where results will be stored [Default: results.txt].
+            -r, --rebuild              Build the transport graph for each delta instead of a single time.
             delta                      Value used to determine which node acts as a controller.
         """
         try:
@@ -304,6 +365,14 @@ For more information about any commands hit :
             outputFile.write(f"[d] - ExpectedResults\n")
             outputFile.write(f"{retTab}\n")
 
+        deltas = [d.item() for d in arange(dstart, dend, dstep)]
+        if not rebuild and deltas:
+            # The delay of each forwarded transmission gives the deltas
+            # for which it is found, the graph is built once
+            thresholds = self.dbc.controllerThresholds(0.6, max(deltas))
+            calibrate_controller_delta(retTab.copy(), thresholds, deltas, plot=True, debug=output)
+            return
+
         with ProgressBar() as pb:
             graphs = {}
             for d in pb(arange(dstart, dend, dstep)):
@@ -314,6 +383,71 @@ For more information about any commands hit :
             # tdelta = get_optimal_delta(retTab.copy(), graphs, plot=True, isT1=True, debug=output)
             plot_controller_delta(retTab.copy(), graphs, plot=True, debug=output)
 
+    @command
+    def gridSearch(self, filename:str, tdelta1:str, tdelta2:str, adelta:str, thread:int, output:str=None):
+        """GridSearch
+        Grid search mode of compareTo: compare the expected results with the graphs built from each
+        combination of tdelta1, tdelta2 and adelta. The combinations are evaluated by several processes,
+        each one on its own in-memory copy of the current network graph.
+
+        Usage: gridSearch [-h] (--filename <filename>) [--tdelta1 <tdelta1>] [--tdelta2 <tdelta2>] [--adelta <adelta>]
+                          [--thread <thread>] [--output <output>]
+
+        Options:
+            -h, --help                 Print this help menu.
+            -f, --filename <filename>  Csv File containing expected results to compare with.
+            --tdelta1 <tdelta1>        Values of tdelta1: start:end:step or a list v1,v2,... [default: 0.6].
+            --tdelta2 <tdelta2>        Values of tdelta2: start:end:step or a list v1,v2,... [default: 0.7].
+            --adelta <adelta>          Values of adelta: start:end:step or a list v1,v2,... [default: 1.5].
+            -t, --thread <thread>      Number of processes [default: 1].
+            -o, --output <output>      Csv file where the precision and recall of each combination are stored.
+
+        Remarks:
+            The network graph must be built first (nwkGraph). The plots of each delta
+            (other deltas set to the best combination) are stored in tests/plot-*.png.
+        """
+        try:
+            with open(filename, 'r') as csvFile:
+                expected = convert_str_to_array([line.strip() for line in csvFile.readlines()])
+        except IOError as ioe:
+            print(f'Error while opening the file...\n{ioe}')
+            return False
+
+        try:
+            deltas = [parse_values(values) for values in (tdelta1, tdelta2, adelta)]
+        except ValueError as ve:
+            print(f"Wrong delta values: {ve}")
+            return False
+
+        with ProgressBar(title='Grid search (combinations evaluated)') as pb:
+            counter = pb(label='deltas', total=len(deltas[0]) * len(deltas[1]) * len(deltas[2]))
+            def progress(done, total):
+                counter.items_completed = done
+                pb.invalidate()
+
+            table = self.dbc.gridSearch(expected, *deltas, thread, progress)
+            counter.done = True
+
+        best = plot_grid_search(table, plot=True)
+
+        table_data = [["tdelta1", "tdelta2", "adelta", "precision", "recall"]]
+        for line in table:
+            table_data.append([f"{v:.3f}" for v in line])
+
+        table = AsciiTable(table_data)
+        table.inner_column_border = False
+        table.inner_footing_row_border = False
+        table.inner_heading_row_border = True
+        table.inner_row_border = False
+        table.outer_border = False
+
+        print(f"{table.table}\n")
+        print(f"Best combination: tdelta1={best[0]}, tdelta2={best[1]}, adelta={best[2]} (precision {best[3]:.3f}, recall {best[4]:.3f})")
+
+        if output is not None:
+            with open(output, 'w') as outputFile:
+                csv.writer(outputFile).writerows(table_data)
+
     def updateGraphOptions(self):
         self.graphs = {
             1: {
@@ -328,14 +462,17 @@ For more information about any commands hit :
                 'func': self.dbc.transGraph,
                 'options': [self.options["tdelta1"]['Current Settings'],
                             self.options["tdelta2"]['Current Settings'],
-                            self.options["csvFile"]['Current Settings']]
+                            self.options["csvFile"]['Current Settings'],
+                            self.options["controllersFile"]['Current Settings']]
             },
             4: {
                 'func': self.dbc.appGraph,
                 'options': [self.options["adelta"]['Current Settings'],
                             self.options["tdelta1"]['Current Settings'],
                             self.options["tdelta2"]['Current Settings'],
-                            self.options["csvFile"]['Current Settings']]
+                            self.options["csvFile"]['Current Settings'],
+                            self.options["controllersFile"]['Current Settings'],
+                            self.options["maxHops"]['Current Settings']]
             }
         }
         
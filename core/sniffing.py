@@ -16,6 +16,9 @@ from signal import SIGINT, signal
 from sniffer.sixlowpanSniffer import sixlowpanSniffer
 from sniffer.bleSniffer import bleSniffer
 from sniffer.zigbeeSniffer import zigbeeSniffer
+from sniffer.stream import FrameExtractor, GraphUpdater, queue_depth, DEFAULT_FRAMES_QUEUE, DEFAULT_ROWS_QUEUE
+from sniffer.ring import FrameRing, supported
+import multiprocessing
 
 getSniffers = {
     'zigbee': zigbeeSniffer,
@@ -67,6 +70,8 @@ class Sniffing:
         # }
 
         self.sniffers = {}
+        # Queues, extractor and updater of the streaming mode
+        self.streaming = None
 
         self.dc = dbController
         
@@ -232,6 +237,173 @@ class Sniffing:
         return 
 
 
+    @command
+    def stream(self, identifier: list, level: int, tdelta1: float, tdelta2: float, adelta: float, lag: float, coap: float, new: bool, ring: int=None):
+        """
+        Launch defined sniffers in streaming mode: the frames are converted and appended to the graphs
+        while they are captured (see the appendGraph command of the modelling mode)
+
+        Usage: stream [--identifier <identifier>]... [--level <level>] [--tdelta1 <tdelta1>] [--tdelta2 <tdelta2>]
+                      [--adelta <adelta>] [--lag <lag>] [--coap <coap>] [--ring <ring>] [--new] [-h]
+
+        Options:
+            -h, --help                     Print this help menu.
+            -i, --identifier <identifier>  Id of sniffer(s) to start.
+            -l, --level <level>            Number of layers of the graph built with --new [default: 4].
+            --tdelta1 <tdelta1>            Delay for an object to respond to a request [default: 0.6].
+            --tdelta2 <tdelta2>            Delay for an object to forward a packet [default: 0.7].
+            --adelta <adelta>              Delay for a controller to forward a packet [default: 1.5].
+            --lag <lag>                    Seconds the rows wait to be ordered by timestamp [default: 2].
+            --coap <coap>                  Seconds a CoAP message waits for its retransmissions [default: 45].
+            -r, --ring <ring>              Size in bytes of a shared memory ring for each sniffer, instead of the queue.
+            -n, --new                      Start from empty graphs instead of the current ones.
+
+        Remarks:
+        The deltas must be the ones used to build the current graphs, which must have been built
+        or started (--new) since the streaming mode exists.
+        The 6LoWPAN rows are sent once their CoAP retransmissions can't follow anymore, like the
+        cleaning of importPcaps. The lag is raised by --coap when they are streamed with other protocols.
+        Use streamStatus to display the depth of the queues.
+        The rings avoid the pickling of the frames for high rate captures, they need python 3.8
+        and a x86-64 processor (the queue is used otherwise).
+        """
+        if self.streaming is not None:
+            print("[e] The streaming mode is already running, stop it with stopStream first.")
+            return
+
+        if new:
+            self.dc.initGraph(level)
+        elif 2 not in self.dc.watermarks():
+            print("[e] The current graphs have no watermark, rebuild them or use --new.")
+            return
+
+        started = []
+        for s in self.sniffers.keys():
+            if len(identifier) != 0:
+                if not str(s) in identifier:
+                    continue
+
+            if not self.sniffers[s]['thread'].is_alive():
+                started.append(s)
+
+        if not started:
+            print("[w] No sniffer to start.")
+            return
+
+        if ring and not supported():
+            print("[w] Ring buffers are not supported on this platform, the frames go through the queue.")
+            ring = None
+
+        # Each sniffer has its own ring, it is the only producer
+        frames = None if ring else multiprocessing.Queue(DEFAULT_FRAMES_QUEUE)
+        rings = {s: FrameRing(ring) for s in started} if ring else {}
+        for s in started:
+            self.sniffers[s]['thread'].stream(rings[s] if ring else frames)
+
+        # The 6LoWPAN rows are late compared to the rows of the other sniffers
+        protocols = set(self.sniffers[s]['thread'].protocol for s in started)
+        if 'OS4I' in protocols and len(protocols) > 1:
+            lag += coap
+            print(f"[i] The lag is raised to {lag}s to order the 6LoWPAN rows with the other ones")
+
+        rows = multiprocessing.Queue(DEFAULT_ROWS_QUEUE)
+        extractor = FrameExtractor(frames, rows, rings=[(self.sniffers[s]['thread'].protocol, r) for s, r in rings.items()], coapWindow=coap)
+        updater = GraphUpdater(self.dc, rows, (tdelta1, tdelta2, adelta), lag)
+
+        updater.start()
+        extractor.start()
+        for s in started:
+            self.sniffers[s]['thread'].start()
+            print(f"[i] Sniffer with the id {s} and the name {self.sniffers[s]['name']} is streaming")
+
+        self.streaming = {
+            'frames': frames,
+            'rings': rings,
+            'rows': rows,
+            'extractor': extractor,
+            'updater': updater,
+            'sniffers': started
+        }
+
+    @command
+    def streamStatus(self):
+        """
+        Display the queues of the streaming mode, a growing queue means the next stage can't keep up
+
+        Usage: streamStatus [-h]
+
+        Options:
+            -h, --help  Print this help menu.
+        """
+        if self.streaming is None:
+            print("The streaming mode is not running.")
+            return
+
+        extractor, updater = self.streaming['extractor'], self.streaming['updater']
+        depth = lambda q: 'n/a' if queue_depth(q) is None else queue_depth(q)
+
+        table_data = [
+            ["Stage", "Queue", "Received", "Sent", "Dropped"]
+        ]
+        for s in self.streaming['sniffers']:
+            sniffer = self.sniffers[s]['thread']
+            pushed, dropped = sniffer.counters()
+            # The ring of a sniffer shows the frames and bytes waiting for the extractor
+            if s in self.streaming['rings']:
+                r = self.streaming['rings'][s]
+                waiting = f"{r.depth()} ({r.used()}/{r.capacity} B)"
+            else:
+                waiting = ''
+            table_data.append([f"sniffer {s} ({sniffer.name})", waiting, '', pushed, dropped])
+        frames = '' if self.streaming['frames'] is None else depth(self.streaming['frames'])
+        table_data.append(["extractor", frames, extractor.received.value, extractor.extracted.value, ''])
+        table_data.append(["updater", depth(self.streaming['rows']), updater.received, updater.appended, updater.late])
+
+        table = AsciiTable(table_data)
+        table.inner_column_border = False
+        table.inner_footing_row_border = False
+        table.inner_heading_row_border = True
+        table.inner_row_border = False
+        table.outer_border = False
+
+        print (f'\nStreaming mode:\n\n{table.table}\n')
+        delay = updater.delay()
+        if delay is not None:
+            print(f"[i] {len(updater.pending)} rows waiting to be ordered, the graph is {delay:.1f}s behind\n")
+
+    @command
+    def stopStream(self):
+        """
+        Stop the sniffers of the streaming mode, the rows already captured are appended to the graphs
+
+        Usage: stopStream [-h]
+
+        Options:
+            -h, --help  Print this help menu.
+        """
+        if self.streaming is None:
+            print("The streaming mode is not running.")
+            return
+
+        # Each stage is stopped once the previous one has stopped
+        for s in self.streaming['sniffers']:
+            if s in self.sniffers and self.sniffers[s]['thread'].is_alive():
+                self.sniffers[s]['thread'].terminate()
+                self.sniffers[s]['thread'].join()
+                print(f"[i] Sniffer with the id {s} and the name {self.sniffers[s]['name']} is stopped")
+            if s in self.sniffers:
+                self.sniffers[s]['thread'] = getSniffers[self.sniffers[s]['protocol']](self.sniffers[s]['opt'])
+
+        for stage in (self.streaming['extractor'], self.streaming['updater']):
+            stage.terminate()
+            stage.join()
+
+        for r in self.streaming['rings'].values():
+            r.close()
+
+        print(f"[i] {self.streaming['updater'].appended} transmissions appended to the graphs")
+        self.streaming = None
+
     @command
     def stopSniffer(self, identifier: list):
         """
@@ -0,0 +1,72 @@
+"""
+Benchmark of the network graph generation (nwkGraph)
+
+Build a synthetic data link graph with a growing number of transmissions
+and measure the time to generate the network graph from it. The time per
+edge must stay the same whatever the number of edges.
+WARNING: the content of the database is erased.
+
+Usage:
+    benchmark.py [--nodes <nodes>] [--edges <edges>]... [--uri <uri>] [--user <user>] [--password <password>]
+
+Options:
+    -h, --help                   Show this help menu.
+    -n, --nodes <nodes>          Number of nodes of the graph [default: 200].
+    -e, --edges <edges>          Number of transmissions of a run (several runs can be given).
+    --uri <uri>                  Uri of the neo4j database [default: bolt://localhost:7687].
+    --user <user>                User of the neo4j database [default: neo4j].
+    --password <password>        Password of the neo4j database [default: iotmap].
+
+Examples:
+    python3 -m database.benchmark -n 200 -e 10000 -e 20000 -e 40000 -e 80000
+"""
+from docopt import docopt
+from database.nodesdatabase import NodesDatabase
+import random
+import time
+
+# Nodes have a single dl and nwk address
+def synthetic_nodes(nbNodes):
+    return [[i, [f'dl-{i}'], [f'nwk-{i}'], 2, []] for i in range(nbNodes)]
+
+# Transmissions between random pairs of nodes
+def synthetic_transmissions(nbNodes, nbEdges):
+    nodesTX = {}
+    for i in range(nbEdges):
+        src, dst = random.sample(range(nbNodes), 2)
+        nodesTX[f'nodeTX{i}'] = {
+            "protocol": 'zigbee',
+            "timestamp": float(i),
+            "dlsrc": f'dl-{src}',
+            "dldst": f'dl-{dst}',
+            "nwksrc": f'nwk-{src}',
+            "nwkdst": f'nwk-{dst}',
+            "apptype": 2,
+            "data": 'get_data'
+        }
+
+    return nodesTX
+
+def run(db, nbNodes, nbEdges):
+    db.del_nodes(2, 'node')
+    db.del_nodes(2, 'visu')
+    db.create_nodes(synthetic_nodes(nbNodes))
+    db.create_nodesTX(synthetic_transmissions(nbNodes, nbEdges))
+
+    start = time.time()
+    db.nwkGraph()
+
+    return time.time() - start
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    nbNodes = int(args['--nodes'])
+    edges = [int(e) for e in args['--edges']] or [10000, 20000, 40000, 80000]
+
+    db = NodesDatabase(args['--uri'], args['--user'], args['--password'])
+    print(f"{'edges':>10} {'time (s)':>10} {'us/edge':>10}")
+    for nbEdges in edges:
+        elapsed = run(db, nbNodes, nbEdges)
+        print(f"{nbEdges:>10} {elapsed:>10.2f} {1e6 * elapsed / nbEdges:>10.1f}")
+
+    db.close()
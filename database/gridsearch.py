@@ -0,0 +1,66 @@
+from multiprocessing import Pool
+from itertools import product
+from database.memorydatabase import MemoryDatabase
+from utils.utils import convert_str_to_array, compare2arrays
+
+# Grid search of the deltas of the transport and application layers.
+# Each combination (tdelta1, tdelta2, adelta) is evaluated by a worker on its
+# own in-memory copy of the network graph (see MemoryDatabase.nwkSnapshot),
+# the snapshot and the expected results are sent once to each worker.
+
+snapshot = None
+expected = None
+
+def init_worker(nwkSnapshot, expectedResult):
+    global snapshot, expected
+    snapshot = nwkSnapshot
+    expected = expectedResult
+
+# Rows of getResults in the format of the files of expected results
+# (see Modelling.get_current_graph)
+def results_to_array(results):
+    return convert_str_to_array([str(line)[1:-1] for line in results])
+
+# Build the transport and application graphs with the deltas and compare
+# them with the expected results
+# Return (tdelta1, tdelta2, adelta, precision, recall)
+def evaluate(deltas):
+    tdelta1, tdelta2, adelta = deltas
+
+    db = MemoryDatabase()
+    db.load_nwk(snapshot)
+    # A negative tdelta2 disables the controllers (see DBController.transGraph)
+    db.transGraph(tdelta1, tdelta2 if tdelta2 >= 0. else None)
+    db.appGraph(adelta)
+
+    falseNeg, falsePos, truePos = compare2arrays(expected, results_to_array(db.getResults()))
+    precision = len(truePos) / (len(truePos) + len(falsePos)) if truePos or falsePos else 0.
+    recall = len(truePos) / (len(truePos) + len(falseNeg)) if truePos or falseNeg else 0.
+
+    return tdelta1, tdelta2, adelta, precision, recall
+
+# Evaluate all combinations of the deltas in a pool of nbThread processes
+# progress is called with the number of combinations evaluated
+# Return the results in the order of the combinations
+def grid_search(nwkSnapshot, expectedResult, tdeltas1, tdeltas2, adeltas, nbThread=1, progress=None):
+    grid = list(product(tdeltas1, tdeltas2, adeltas))
+    nbThread = int(nbThread)
+
+    results = {}
+    if nbThread <= 1:
+        init_worker(nwkSnapshot, expectedResult)
+        evaluated = map(evaluate, grid)
+    else:
+        pool = Pool(nbThread, initializer=init_worker, initargs=(nwkSnapshot, expectedResult))
+        evaluated = pool.imap_unordered(evaluate, grid)
+
+    try:
+        for result in evaluated:
+            results[tuple(result[:3])] = result
+            if progress is not None:
+                progress(len(results), len(grid))
+    finally:
+        if nbThread > 1:
+            pool.terminate()
+
+    return [results[deltas] for deltas in grid]
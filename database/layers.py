@@ -0,0 +1,265 @@
+from bisect import bisect_left
+
+# Pure python part of the transport and application layers.
+# These functions work on the values read from a backend (neo4j or memory)
+# and return the updates to apply, so all backends build the same graphs.
+
+# Group the nwk transmissions by source node
+# results is a list of (srcID, nwksrc, dstID, nwkdst, timestamps)
+# The timestamps of the addresses of a pair of nodes are merged
+# Return {srcID: {dstID: timestamps, ..., 'id': srcID, 'role': []}}
+def group_transmissions(results):
+    transNodes = {}
+
+    for (srcID, dstID), txG in conversation_pairs(results).items():
+        if srcID not in transNodes.keys():
+            transNodes[srcID] = {'id': srcID, 'role': []}
+        transNodes[srcID][dstID] = txG
+
+    return transNodes
+
+# Timestamps of the nwk transmissions of each pair of nodes
+# results is a list of (srcID, nwksrc, dstID, nwkdst, timestamps)
+# Return {(srcID, dstID): sorted distinct timestamps}
+def conversation_pairs(results):
+    pairs = {}
+    for srcID, srcN, dstID, dstN, txG in results:
+        if (srcID, dstID) in pairs:
+            pairs[(srcID, dstID)] = sorted(set(pairs[(srcID, dstID)]).union(txG))
+        else:
+            pairs[(srcID, dstID)] = list(txG)
+
+    return pairs
+
+# Find the roles of the nodes from their communications
+# Yield (srcID, dstID, srcRole, dstRole, timestamps, append) for each TRANSEdge
+# to merge. The roles are set when the edge is created, they are added
+# to the current roles of the nodes if append is True.
+def request_responses(transNodes, delta):
+    for src in transNodes.keys():
+        for dst in transNodes[src].keys():
+            if 'role' == dst or 'id' == dst:
+                continue
+
+            # Communication are only one-way
+            source = src
+            sink = dst
+
+            # Dst only received so Dst is a sink
+            # And so we are a one way communication
+            if not dst in transNodes.keys():
+                if 'source' not in transNodes[src]['role']:
+                    transNodes[src]['role'].append('source')
+                srcRole = list(set(transNodes[src]['role']))
+                dstRole = ['sink']
+                yield source, sink, srcRole, dstRole, transNodes[source][sink], True
+
+            # here we have a one-way communication src to dst
+            elif src not in transNodes[dst].keys():
+                if 'source' not in transNodes[src]['role']:
+                    transNodes[src]['role'].append('source')
+                if 'sink' not in transNodes[dst]['role']:
+                    transNodes[dst]['role'].append('sink')
+
+                srcRole = list(set(transNodes[src]['role']))
+                dstRole = list(set(transNodes[dst]['role']))
+                yield source, sink, srcRole, dstRole, transNodes[source][sink], False
+
+            # bidirectional communications
+            # dst is a source if it responded to src, the edge is merged once
+            elif follows(transNodes[src][dst], transNodes[dst][src], delta):
+                if 'source' not in transNodes[dst]['role']:
+                    transNodes[dst]['role'].append('source')
+                if 'sink' not in transNodes[src]['role']:
+                    transNodes[src]['role'].append('sink')
+                source = dst
+                sink = src
+                srcRole = list(set(transNodes[source]['role']))
+                dstRole = list(set(transNodes[sink]['role']))
+                yield source, sink, srcRole, dstRole, transNodes[dst][src], False
+
+# Edge and roles given by the messages sent from a to b, the same as
+# request_responses once all the pairs are processed: the roles of a node
+# are the union of the roles given by each of its pairs.
+# pairs is {(srcID, dstID): timestamps} (see conversation_pairs)
+# Return (edge, roles) where edge is (source, sink, timestamps) or None
+# and roles a list of (nameID, role)
+def pair_transport(a, b, pairs, delta):
+    ts = pairs[(a, b)]
+    # one-way communication
+    if (b, a) not in pairs:
+        return (a, b, ts), [(a, 'source'), (b, 'sink')]
+    # b is a source if it responded to a
+    if follows(ts, pairs[(b, a)], delta):
+        return (b, a, pairs[(b, a)]), [(b, 'source'), (a, 'sink')]
+    return None, []
+
+# Transport graph around some nodes, when new transmissions are appended
+# pairs must hold all the pairs of the nodes, edges are only returned for
+# the pairs between the nodes of between (a set of frozenset((a, b)))
+# Return (edges, roles) with the (source, sink, timestamps) of the edges and
+# {nameID: sorted roles} for each node
+def transport_update(pairs, nodes, between, delta):
+    edges = []
+    roles = {node: set() for node in nodes}
+    for a, b in pairs:
+        edge, given = pair_transport(a, b, pairs, delta)
+        for node, role in given:
+            if node in roles:
+                roles[node].add(role)
+        if edge is not None and frozenset((a, b)) in between:
+            edges.append(edge)
+
+    return edges, {node: sorted(role) for node, role in roles.items()}
+
+# Find the transmissions forwarded by a controller
+# results is a list of (src, ctrl, sink, timestamps1, timestamps2) where
+# ctrl received from src then sent to sink, other values of a row are ignored
+# Yield (src, ctrl, sink, t1, t2) for each message t2 sent less than delta
+# after a message t1. Both lists are sorted, the messages t1 of each t2 are
+# in a window that slides along timestamps1.
+def forwarded_transmissions(results, delta):
+    for line in results:
+        source, controller, sink, ts1, ts2 = line[:5]
+
+        if isinstance(controller, list):
+            controller = controller[0]
+
+        # ts1[first:last] are the messages received less than delta before t2
+        first = last = 0
+        for t2 in ts2:
+            while first < len(ts1) and t2 - ts1[first] >= delta:
+                first += 1
+            while last < len(ts1) and ts1[last] < t2:
+                last += 1
+            # we get a controller
+            for t1 in ts1[first:last]:
+                yield source, controller, sink, t1, t2
+
+# Row of a forwarded transmission as returned by transGraph
+def controller_row(source, controller, sink, t1, t2):
+    return [source, [str(t1)], [controller], [str(t2)], sink]
+
+# Rows of the forwarded transmissions with the delay of the controller
+# A row is returned by transGraph for any delta2 greater than its delay,
+# only the rows with a delay lower than maxDelta are given
+def controller_thresholds(results, maxDelta):
+    return [(controller_row(source, controller, sink, t1, t2), t2 - t1) for source, controller, sink, t1, t2 in forwarded_transmissions(results, maxDelta)]
+
+# Format the forwarded transmissions as returned by transGraph
+# They are also written in the output file if one is given
+# Return the transmissions and the controllers
+def controller_results(forwarded, output=None):
+    toreturn = []
+    controllers = []
+
+    outputFile = open(output, 'w') if output is not None else None
+    try:
+        for source, controller, sink, t1, t2 in forwarded:
+            toreturn.append(controller_row(source, controller, sink, t1, t2))
+            if controller not in controllers:
+                controllers.append(controller)
+            if outputFile is not None:
+                outputFile.write(f"{source}, [{t1}], [{controller}], [{t2}], {sink}\n")
+    finally:
+        if outputFile is not None:
+            outputFile.close()
+
+    return toreturn, controllers
+
+# Controllers found on the paths through each node
+# The rows of results end with the nameID of the node in the middle
+# of the path (see forwarded_transmissions)
+# Return {nameID: [controller]}
+def forwarded_by(results, delta):
+    controllers = {}
+    for line in results:
+        for source, controller, sink, t1, t2 in forwarded_transmissions([line], delta):
+            found = controllers.setdefault(line[5], [])
+            if controller not in found:
+                found.append(controller)
+            # all transmissions of a row give the same controller
+            break
+
+    return controllers
+
+# True if a message of TX2 follows a message of TX1 by less than delta
+# Both lists are sorted, the closest message of TX1 before each message
+# of TX2 is found by bisection
+def follows(TX1, TX2, delta):
+    for t2 in TX2:
+        i = bisect_left(TX1, t2)
+        if i > 0 and t2 - TX1[i - 1] < delta:
+            return True
+    return False
+
+# Find the interactions source -> ... -> controller -> ... -> sink
+# roles is {node: role}, edges is the list of (src, dst, timestamps) of the
+# transport graph.
+# The paths are searched breadth first from each source, an edge is only
+# followed if one of its messages follows a message of the previous edge by
+# less than delta. A path is known by its last edge and whether a controller
+# is inside it, so each (edge, controller) is visited once per source.
+# maxHops bounds the number of edges of a path (no bound if None).
+# Only the paths from the sources in starts are searched if it is given.
+# Return the (source, sink) pairs in order of discovery, each pair once
+def interactions(roles, edges, delta, maxHops=None, starts=None):
+    out = {}
+    for i, (src, dst, ts) in enumerate(edges):
+        out.setdefault(src, []).append(i)
+
+    # Edges that can follow each edge, computed once for all sources
+    successors = {}
+    def following(i):
+        if i not in successors:
+            ts = edges[i][2]
+            successors[i] = [j for j in out.get(edges[i][1], []) if follows(ts, edges[j][2], delta)]
+        return successors[i]
+
+    pairs = []
+    found = set()
+    for start, role in roles.items():
+        if 'source' not in role or (starts is not None and start not in starts):
+            continue
+
+        frontier = [(i, False) for i in out.get(start, [])]
+        visited = set(frontier)
+        hops = 1
+        while frontier and (maxHops is None or hops < maxHops):
+            nextFrontier = []
+            for i, controller in frontier:
+                # The end of the edge is now inside the path
+                controller = controller or 'controller' in roles[edges[i][1]]
+                for j in following(i):
+                    sink = edges[j][1]
+                    if controller and sink != start and 'sink' in roles[sink] and (start, sink) not in found:
+                        found.add((start, sink))
+                        pairs.append((start, sink))
+
+                    state = (j, controller)
+                    if state not in visited:
+                        visited.add(state)
+                        nextFrontier.append(state)
+
+            frontier = nextFrontier
+            hops += 1
+
+    return pairs
+
+# Nodes with a path to one of the nodes, whatever the timestamps
+# edges is the list of (src, dst, ...) of the graph
+# Return the set of these nodes, the nodes themselves included
+def reaching(edges, nodes):
+    into = {}
+    for edge in edges:
+        into.setdefault(edge[1], []).append(edge[0])
+
+    found = set(nodes)
+    stack = list(found)
+    while stack:
+        for src in into.get(stack.pop(), []):
+            if src not in found:
+                found.add(src)
+                stack.append(src)
+
+    return found
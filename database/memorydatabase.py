@@ -0,0 +1,462 @@
+import time
+import logging
+from database import layers
+
+# In-memory implementation of the graphs stored by NodesDatabase.
+# It provides the same methods and gives the same results (getResults)
+# without a neo4j server: each label is a Graph with its nodes, an index of
+# the addresses and the list of its edges. The transmissions are read in
+# order of timestamp, the transport and application layers use the same
+# functions as the neo4j backend (see database.layers).
+# The visual nodes ('l2', 'l3') are only useful in the neo4j browser and
+# are not built.
+
+class Graph(object):
+    def __init__(self, label):
+        self.label = label
+        # nameID -> node properties
+        self.nodes = {}
+        # (layer, value) -> [nameID]
+        self.addresses = {}
+        # Edges in order of creation, an edge is a dict with its type,
+        # the nameID of its nodes (src, dst) and its properties
+        self.edges = []
+        # nameID -> [edge] for the edges of a node, whatever their direction
+        self.incident = {}
+        # (type, src, dst, key) -> edge, for the merged edges
+        self.merged = {}
+
+    # Add a node or update the properties of an existing one
+    def add_node(self, node):
+        nameID = node['nameID']
+        if nameID in self.nodes:
+            self.index(self.nodes[nameID], remove=True)
+            self.nodes[nameID].update(node)
+        else:
+            self.nodes[nameID] = node
+            self.incident[nameID] = []
+        self.index(self.nodes[nameID])
+
+    def index(self, node, remove=False):
+        for layer, values in (('dl', node['dlsrc']), ('nwk', node['nwksrc'])):
+            for value in values:
+                if remove:
+                    self.addresses[(layer, value)].remove(node['nameID'])
+                else:
+                    self.addresses.setdefault((layer, value), []).append(node['nameID'])
+
+    def remove_node(self, nameID):
+        self.index(self.nodes.pop(nameID), remove=True)
+        self.remove_edges(self.incident.pop(nameID))
+
+    # Edges are removed by identity, two edges can have the same properties
+    def remove_edges(self, removed):
+        removed = {id(e): e for e in removed}
+        self.edges = [e for e in self.edges if id(e) not in removed]
+        for e in removed.values():
+            for n in (e['src'], e['dst']):
+                if n in self.incident:
+                    self.incident[n] = [r for r in self.incident[n] if id(r) not in removed]
+        self.merged = {k: e for k, e in self.merged.items() if id(e) not in removed}
+
+    # nameID of the nodes with the address value at the given layer
+    def lookup(self, layer, value):
+        return self.addresses.get((layer, value), [])
+
+    def add_edge(self, type, src, dst, properties):
+        edge = {'type': type, 'src': src, 'dst': dst, 'properties': properties}
+        self.edges.append(edge)
+        self.incident[src].append(edge)
+        if dst != src:
+            self.incident[dst].append(edge)
+        return edge
+
+    # Create the edge if there is no edge of this type with the same key
+    # between both nodes. Return True if the edge is created
+    def merge_edge(self, type, src, dst, key, properties):
+        if (type, src, dst, key) in self.merged:
+            return False
+        self.merged[(type, src, dst, key)] = self.add_edge(type, src, dst, properties)
+        return True
+
+    def clear_edges(self):
+        self.edges = []
+        self.merged = {}
+        for nameID in self.incident:
+            self.incident[nameID] = []
+
+    def edges_of_type(self, type):
+        return [e for e in self.edges if e['type'] == type]
+
+# Lists are stored as tuples in the keys of the merged edges
+def freeze(value):
+    return tuple(value) if isinstance(value, list) else value
+
+class MemoryDatabase(object):
+    def __init__(self):
+        # label -> Graph
+        self.graphs = {}
+        # label -> timestamp of the last transmission processed by the layer
+        self.marks = {}
+
+    def close(self):
+        self.graphs = {}
+        self.marks = {}
+
+    def graph(self, label):
+        if label not in self.graphs:
+            self.graphs[label] = Graph(label)
+        return self.graphs[label]
+
+    # The layers are identified by an integer label, the visual ones
+    # by a string. Only the first ones are deleted from a label.
+    def labels_from(self, label):
+        return [l for l in self.graphs if isinstance(l, int) and l >= label]
+
+    # There is no schema to create
+    def bootstrap(self):
+        return False
+
+    def check_schema(self):
+        return []
+
+    # Copy the nodes of a label (without their edges) to another label
+    # Only the nodes missing from label_dst are copied if missing is True
+    def duplicate_node(self, label_src, label_dst, missing=False):
+        dst = self.graph(label_dst)
+        for node in list(self.graph(label_src).nodes.values()):
+            if missing and node['nameID'] in dst.nodes:
+                continue
+            copy = dict(node)
+            copy['label'] = label_dst
+            copy['role'] = list(node['role'])
+            dst.add_node(copy)
+
+    # Create edges corresponding to the network communications
+    # Only the transmissions after since are processed if it is given
+    def nwk_transmission(self, label, since=None):
+        g2, g3 = self.graph(2), self.graph(label)
+        for r in g2.edges_of_type('dlLink'):
+            p = r['properties']
+            if since is not None and p['timestamp'] <= since:
+                continue
+            nwk = set(g3.lookup('nwk', p['nwksrc']))
+            for src in g3.lookup('dl', p['dlsrc']):
+                if src not in nwk:
+                    continue
+                for dst in g3.lookup('nwk', p['nwkdst']):
+                    properties = {key: p[key] for key in ('timestamp', 'dlsrc', 'dldst', 'nwksrc', 'nwkdst', 'apptype', 'data')}
+                    g3.add_edge('nwkLink', src, dst, properties)
+
+    # Nodes of the data link layer and transmissions of the network layer,
+    # all the transport and application layers are built from them
+    def nwkSnapshot(self):
+        return {
+            'nodes': [[n['nameID'], n['dlsrc'], n['nwksrc'], n['role']] for n in self.graph(2).nodes.values()],
+            'links': [[e['src'], e['dst'], e['properties']] for e in self.graph(3).edges_of_type('nwkLink')]
+        }
+
+    # Replace the graphs with the ones of a snapshot
+    def load_nwk(self, snapshot):
+        self.graphs = {}
+        self.create_nodes([[nameID, dlsrc, nwksrc, 2, role] for nameID, dlsrc, nwksrc, role in snapshot['nodes']])
+        self.duplicate_node(2, 3)
+        g3 = self.graph(3)
+        for src, dst, properties in snapshot['links']:
+            g3.add_edge('nwkLink', src, dst, dict(properties))
+
+    # Same rows as the first query of NodesDatabase.transport_transmission_part1:
+    # (srcID, nwksrc, dstID, nwkdst, timestamps) with the sorted distinct timestamps
+    # of each pair of addresses, the pairs are given in order of first transmission
+    # Only the transmissions after since, or the ones of the given nodes,
+    # are read if since or nodes is given
+    def nwk_conversations(self, since=None, nodes=None):
+        g3 = self.graph(3)
+        links = []
+        for r in g3.edges_of_type('nwkLink'):
+            p = r['properties']
+            if since is not None and p['timestamp'] <= since:
+                continue
+            for src in g3.lookup('nwk', p['nwksrc']):
+                for dst in g3.lookup('nwk', p['nwkdst']):
+                    if nodes is None or src in nodes or dst in nodes:
+                        links.append((p['timestamp'], src, p['nwksrc'], dst, p['nwkdst']))
+
+        conversations = {}
+        for tp, srcID, nsrc, dstID, mdst in sorted(links, key=lambda x: x[0]):
+            timestamps = conversations.setdefault((srcID, nsrc, dstID, mdst), [])
+            if tp not in timestamps:
+                timestamps.append(tp)
+
+        return [[srcID, nsrc, dstID, mdst, timestamps] for (srcID, nsrc, dstID, mdst), timestamps in conversations.items()]
+
+    def transport_transmission_part1(self, delta):
+        g4 = self.graph(4)
+        transNodes = layers.group_transmissions(self.nwk_conversations())
+
+        for source, sink, srcRole, dstRole, ts, append in layers.request_responses(transNodes, delta):
+            n, m = g4.nodes.get(source), g4.nodes.get(sink)
+            if n is None or m is None:
+                continue
+
+            properties = {'nwksrc': n['nwksrc'], 'nwkdst': m['nwksrc'], 'timestamp': ts}
+            key = tuple(freeze(properties[k]) for k in ('nwksrc', 'nwkdst', 'timestamp'))
+            if g4.merge_edge('TRANSEdge', source, sink, key, properties):
+                if append:
+                    n['role'] = n['role'] + srcRole
+                    m['role'] = m['role'] + dstRole
+                else:
+                    n['role'] = list(srcRole)
+                    m['role'] = list(dstRole)
+
+        # Roles before the controllers are found
+        for node in g4.nodes.values():
+            node['transRole'] = list(node['role'])
+
+    # Same rows as the query of NodesDatabase.transport_transmission_part2:
+    # paths n-[r1]-m-[r2]-d (any direction, r1 <> r2) where m both sent and
+    # received, n sent and d received, followed by the nameID of m
+    # Only the paths through the nodes of middles are given if it is set
+    def controller_paths(self, middles=None):
+        g4 = self.graph(4)
+        results = []
+        for nameID, m in g4.nodes.items():
+            if middles is not None and nameID not in middles:
+                continue
+            if not ('source' in m['transRole'] and 'sink' in m['transRole']):
+                continue
+
+            edges = g4.incident[nameID]
+            for r1 in edges:
+                n = g4.nodes[r1['dst'] if r1['src'] == nameID else r1['src']]
+                if not ('source' in n['transRole'] or 'controller' in n['transRole']):
+                    continue
+                for r2 in edges:
+                    if r2 is r1:
+                        continue
+                    d = g4.nodes[r2['dst'] if r2['src'] == nameID else r2['src']]
+                    if n is d or not ('sink' in d['transRole'] or 'controller' in d['transRole']):
+                        continue
+                    p1, p2 = r1['properties'], r2['properties']
+                    results.append([p1['nwksrc'], p1['nwkdst'], p2['nwkdst'], p1['timestamp'], p2['timestamp'], nameID])
+
+        return results
+
+    def transport_transmission_part2(self, delta, controllersFile=None):
+        g4 = self.graph(4)
+        results = self.controller_paths()
+        forwarded = layers.forwarded_transmissions(results, delta)
+        toreturn, controllers = layers.controller_results(forwarded, controllersFile)
+
+        # Controllers found on the paths through each node, kept for appendGraph
+        found = layers.forwarded_by(results, delta)
+        for nameID, node in g4.nodes.items():
+            node['forwarded'] = found.get(nameID, [])
+            if any(ctrl in node['nwksrc'] for ctrl in controllers):
+                node['role'] = ['controller']
+
+        return toreturn
+
+    # Same paths as NodesDatabase.application_transmission
+    def application_transmission(self, delta, maxHops=None):
+        g4, g5 = self.graph(4), self.graph(5)
+        roles = {nameID: node['role'] for nameID, node in g4.nodes.items()}
+        edges = [(e['src'], e['dst'], e['properties']['timestamp']) for e in g4.edges_of_type('TRANSEdge')]
+
+        for source, sink in layers.interactions(roles, edges, delta, maxHops):
+            n, m = g5.nodes.get(source), g5.nodes.get(sink)
+            if n is None or m is None:
+                continue
+            properties = {'nwksrc': n['nwksrc'], 'nwkdst': m['nwksrc']}
+            g5.merge_edge('INTERACT', source, sink, (freeze(n['nwksrc']), freeze(m['nwksrc'])), properties)
+
+    # Process again the pairs of nodes with transmissions after since
+    # (see NodesDatabase.transport_update)
+    # Return the nodes whose edges or roles changed
+    def transport_update(self, since, delta, delta2=None):
+        g4 = self.graph(4)
+        between = {frozenset((line[0], line[2])) for line in self.nwk_conversations(since=since)}
+        nodes = set().union(*between)
+        pairs = layers.conversation_pairs(self.nwk_conversations(nodes=nodes))
+        edges, transRoles = layers.transport_update(pairs, nodes, between, delta)
+
+        g4.remove_edges([e for x in nodes for e in g4.incident.get(x, []) if e['type'] == 'TRANSEdge' and frozenset((e['src'], e['dst'])) in between])
+        for source, sink, ts in edges:
+            n, m = g4.nodes.get(source), g4.nodes.get(sink)
+            if n is None or m is None:
+                continue
+            properties = {'nwksrc': n['nwksrc'], 'nwkdst': m['nwksrc'], 'timestamp': ts}
+            key = tuple(freeze(properties[k]) for k in ('nwksrc', 'nwkdst', 'timestamp'))
+            g4.merge_edge('TRANSEdge', source, sink, key, properties)
+        for nameID, role in transRoles.items():
+            if nameID in g4.nodes:
+                g4.nodes[nameID]['transRole'] = role
+
+        # The controllers found through a node only change if the node or
+        # one of its neighbors has new edges or roles
+        controllers = set()
+        if delta2 is not None:
+            middles = set(g4.nodes).intersection(nodes)
+            for x in list(middles):
+                for e in g4.incident[x]:
+                    middles.update((e['src'], e['dst']))
+            found = layers.forwarded_by(self.controller_paths(middles), delta2)
+            for nameID in middles:
+                g4.nodes[nameID]['forwarded'] = found.get(nameID, [])
+            controllers = {ctrl for node in g4.nodes.values() for ctrl in node.get('forwarded', [])}
+
+        changed = set(g4.nodes).intersection(nodes)
+        for nameID, node in g4.nodes.items():
+            role = ['controller'] if any(ctrl in node['nwksrc'] for ctrl in controllers) else node['transRole']
+            if set(role) != set(node['role']):
+                node['role'] = list(role)
+                changed.add(nameID)
+
+        return changed
+
+    # Search again the interactions from the sources with a path to the
+    # given nodes (see NodesDatabase.interact_update)
+    def interact_update(self, nodes, delta, maxHops=None):
+        g4, g5 = self.graph(4), self.graph(5)
+        for nameID in nodes:
+            g5.nodes[nameID]['role'] = list(g4.nodes[nameID]['role'])
+
+        roles = {nameID: node['role'] for nameID, node in g4.nodes.items()}
+        edges = [(e['src'], e['dst'], e['properties']['timestamp']) for e in g4.edges_of_type('TRANSEdge')]
+        starts = layers.reaching(edges, nodes)
+
+        g5.remove_edges([e for x in starts for e in g5.incident.get(x, []) if e['type'] == 'INTERACT' and e['src'] == x])
+        for source, sink in layers.interactions(roles, edges, delta, maxHops, starts):
+            n, m = g5.nodes[source], g5.nodes[sink]
+            properties = {'nwksrc': n['nwksrc'], 'nwkdst': m['nwksrc']}
+            g5.merge_edge('INTERACT', source, sink, (freeze(n['nwksrc']), freeze(m['nwksrc'])), properties)
+
+        return starts
+
+    ####
+    ###  Following functions are the same as the NodesDatabase ones
+    ####
+
+    def transGraph(self, delta, delta2=None, controllersFile=None):
+        ret = None
+        self.duplicate_node(2, 4)
+        self.transport_transmission_part1(delta)
+        if not delta2 is None:
+            ret = self.transport_transmission_part2(delta2, controllersFile)
+
+        return ret
+
+    def controllerThresholds(self, maxDelta):
+        return layers.controller_thresholds(self.controller_paths(), maxDelta)
+
+    def appGraph(self, delta, maxHops=None):
+        self.duplicate_node(4, 5)
+        self.application_transmission(delta, maxHops)
+
+    def nwkGraph(self):
+        self.duplicate_node(2, 3)
+        self.nwk_transmission(3)
+
+    def nwkAppend(self, since):
+        self.duplicate_node(2, 3, missing=True)
+        self.nwk_transmission(3, since)
+
+    def transAppend(self, since, delta, delta2=None):
+        self.duplicate_node(2, 4, missing=True)
+        for node in self.graph(4).nodes.values():
+            node.setdefault('transRole', list(node['role']))
+
+        return self.transport_update(since, delta, delta2)
+
+    def appAppend(self, nodes, delta, maxHops=None):
+        self.duplicate_node(4, 5, missing=True)
+        return self.interact_update(nodes, delta, maxHops)
+
+    # Timestamp of the last transmission processed by each layer
+    def watermarks(self):
+        return dict(self.marks)
+
+    def set_watermark(self, label, timestamp):
+        self.marks[label] = timestamp
+
+    # A transmission links all the nodes of the data link layer with its addresses
+    # There are no visual nodes, visu is ignored
+    def create_nodesTX(self, nodesTX, batchSize=None, visu=True):
+        g2 = self.graph(2)
+        rows = sorted(nodesTX.values(), key=lambda p: p['timestamp'])
+
+        start = time.time()
+        for properties in rows:
+            for src in g2.lookup('dl', properties['dlsrc']):
+                for dst in g2.lookup('dl', properties['dldst']):
+                    g2.add_edge('dlLink', src, dst, dict(properties))
+
+        elapsed = time.time() - start
+        logging.info(f"[i] {len(rows)} transmissions imported in {elapsed:.2f}s ({len(rows) / elapsed if elapsed else 0:.0f} rows/s)")
+
+    # Nodes are identified by their label and their nameID
+    def create_nodes(self, nodes):
+        for nameID, dlsrc, nwksrc, label, role in nodes:
+            # Several addresses can be given in a single string separated by ';'
+            if isinstance(dlsrc, str):
+                dlsrc = dlsrc.split(';')
+            if isinstance(nwksrc, str):
+                nwksrc = nwksrc.split(';')
+
+            # The transmissions of an existing node are kept
+            self.graph(label).add_node({
+                'label': label,
+                'nameID': nameID,
+                'dlsrc': list(dlsrc),
+                'nwksrc': list(nwksrc),
+                'role': list(role),
+                'neighbors': None
+            })
+
+    def del_nodes(self, label, mode):
+        if 'node' in mode:
+            for l in self.labels_from(label):
+                del self.graphs[l]
+            self.marks = {l: t for l, t in self.marks.items() if l < label}
+
+    # Same rows as NodesDatabase.getResults: each edge of the transport and
+    # application layers seen from the node it starts from
+    def getResults(self):
+        values = []
+        for label in sorted(self.labels_from(4)):
+            g = self.graphs[label]
+            for e in g.edges:
+                nwksrc = e['properties'].get('nwksrc')
+                ends = [(e['src'], e['dst'])]
+                if e['dst'] != e['src']:
+                    ends.append((e['dst'], e['src']))
+                for n, m in ends:
+                    n, m = g.nodes[n], g.nodes[m]
+                    if n['nwksrc'] == nwksrc:
+                        values.append([n['nwksrc'], n['role'], m['nwksrc'], m['role'], e['type']])
+        return values
+
+    def getNodes(self):
+        return [[n['nameID'], n['dlsrc'], n['nwksrc']] for n in self.graph(2).nodes.values()]
+
+    def getNode(self, nodeID):
+        node = [[n['nameID'], n['dlsrc'], n['nwksrc']] for g in self.graphs.values() for n in g.nodes.values() if n['nameID'] == nodeID]
+
+        return node[0]
+
+    def maxID(self):
+        nameIDs = [nameID for g in self.graphs.values() for nameID in g.nodes]
+
+        return [max(nameIDs) if nameIDs else None]
+
+    def removeTX(self, label):
+        for l in self.labels_from(label):
+            self.graphs[l].clear_edges()
+        self.marks = {l: t for l, t in self.marks.items() if l < label}
+
+    def removeNode(self, nodeID):
+        for g in self.graphs.values():
+            if nodeID in g.nodes:
+                g.remove_node(nodeID)
+
+        return []
@@ -1,8 +1,41 @@
 from neo4j import GraphDatabase
 import sys
 import os.path
+import time
+import logging
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 from scapy.utils import hexdump
+from database import layers
+
+# Number of transmissions sent at once to the database
+DEFAULT_BATCH_SIZE = 10000
+
+# Version of the schema (indexes and constraints) needed by the layer queries.
+# Increase it each time a statement is added to SCHEMA, the statements are
+# applied again on the databases created with an older version.
+SCHEMA_VERSION = 1
+
+# A node is identified by its label and its nameID. Both are stored in
+# a single nodeKey property, a composite unique constraint (node key)
+# is not available with the community edition.
+# Each dl and nwk address of a node is an (:Address {value, layer}) node
+# linked to the node with a HAS_ADDRESS edge.
+# Neo4j 3.5 has no index on relationship properties, the timestamps of the
+# transmissions are only read through their nodes.
+SCHEMA = [
+    "create constraint on (n: Node) assert n.nodeKey is unique",
+    "create index on :Node(label)",
+    "create index on :Node(nameID)",
+    "create index on :Address(layer, value)",
+]
+
+# Lookups done by the layer queries, each one must start with an index seek
+SCHEMA_CHECKS = [
+    ("Node by nodeKey", "match (n: Node {nodeKey: $key}) return n", {'key': '2:1'}),
+    ("Node by label", "match (n: Node {label: $label}) return n", {'label': 2}),
+    ("Node by nameID", "match (n: Node) where n.nameID = $nameID return n", {'nameID': 1}),
+    ("Address by value", "match (a: Address {layer: 'dl', value: $value}) return a", {'value': '0x0'}),
+]
 
 class NodesDatabase(object):
     def __init__(self, uri, user, password):
@@ -17,18 +50,30 @@ class NodesDatabase(object):
         tx.run("""
         MATCH (n: Node)
         where n.label >= $label
-        optional match (n)-[r]-()
-        delete r, n""", label=label
+        detach delete n""", label=label
         )
+        cls.delete_orphan_addresses(tx)
         
+    # The links to the addresses of the nodes are kept
     @classmethod
     def delete_transmissions(cls, tx, label):
         tx.run("""
         MATCH (n: Node)
         where n.label >= $label
         optional match (n)-[r]-()
+        where type(r) <> 'HAS_ADDRESS'
         delete r""", label=label
         )
+        cls.delete_orphan_addresses(tx)
+
+    # Delete the addresses that no node has anymore
+    @classmethod
+    def delete_orphan_addresses(cls, tx):
+        tx.run("""
+        MATCH (a: Address)
+        where not (a)<-[:HAS_ADDRESS]-()
+        delete a"""
+        )
 
     # Delete all visual nodes 
     @classmethod
@@ -59,6 +104,114 @@ class NodesDatabase(object):
             merge (n: Node {label: $label, nameID: $nameID, dlsrc: $dlsrc, nwksrc: $nwksrc, role:$role})
         ''', label=label, nameID=nameID, dlsrc=dlsrc, nwksrc=nwksrc, role=role)
 
+    # Copy the nodes of a label missing from another label
+    @classmethod
+    def duplicate_missing_node(cls, tx, label_src, label_dst):
+        tx.run("""
+        match (map: Node {label: $label_src})
+        optional match (old: Node {label: $label_dst, nameID: map.nameID})
+        with map, old
+        where old is null
+        create (copy:Node {label: $label_dst})
+        set copy.nameID = map.nameID, copy.dlsrc = map.dlsrc, copy.nwksrc = map.nwksrc, copy.neighbors = map.neighbors, copy.role = map.role
+        with map, copy
+        match (map)-[:HAS_ADDRESS]->(a: Address)
+        create (copy)-[:HAS_ADDRESS]->(a)
+        """, label_src=label_src, label_dst=label_dst
+        )
+
+    # Timestamp of the last transmission processed by each layer
+    @classmethod
+    def get_watermarks(cls, tx):
+        return dict(tx.run("match (w: Watermark) return w.label, w.timestamp").values())
+
+    @classmethod
+    def merge_watermark(cls, tx, label, timestamp):
+        tx.run("merge (w: Watermark {label: $label}) set w.timestamp = $timestamp", label=label, timestamp=timestamp)
+
+    @classmethod
+    def delete_watermarks(cls, tx, label):
+        tx.run("match (w: Watermark) where w.label >= $label delete w", label=label)
+
+    # Version of the schema stored in the database, 0 if there is none
+    @classmethod
+    def schema_version(cls, tx):
+        version = tx.run("match (s: Schema) return max(s.version)").single()[0]
+        return version or 0
+
+    @classmethod
+    def set_schema_version(cls, tx, version):
+        tx.run("merge (s: Schema) set s.version = $version", version=version)
+
+    # Nodes created before the schema version 1, they have no nodeKey nor Address nodes
+    @classmethod
+    def unmigrated_nodes(cls, tx):
+        return tx.run("""
+            match (n: Node)
+            where n.nodeKey is null
+            return id(n), n.label, n.nameID, n.dlsrc, n.nwksrc
+            """).values()
+
+    # Set the nodeKey of existing nodes and link them to their addresses
+    @classmethod
+    def migrate_node_batch(cls, tx, nodes):
+        tx.run('''
+            unwind $nodes as node
+            match (n: Node)
+            where id(n) = node.id
+            set n.nodeKey = node.nodeKey, n.dlsrc = node.dlsrc, n.nwksrc = node.nwksrc
+            foreach (dl in node.dlsrc | merge (a: Address {layer: 'dl', value: dl}) merge (n)-[:HAS_ADDRESS]->(a))
+            foreach (nwk in node.nwksrc | merge (a: Address {layer: 'nwk', value: nwk}) merge (n)-[:HAS_ADDRESS]->(a))
+        ''', nodes=nodes)
+
+    # Number of nodes of the dl graph that the queries joined on the addresses can't find
+    @classmethod
+    def unlinked_nodes(cls, tx):
+        return tx.run("""
+            match (n: Node {label: 2})
+            where n.nodeKey is null or not (n)-[:HAS_ADDRESS]->(:Address)
+            return count(n)
+            """).single()[0]
+
+    # Schema statements can't be run with other queries in a transaction
+    @classmethod
+    def schema_statement(cls, tx, statement):
+        tx.run(statement)
+
+    # Return the operators of the plan of a query without running it
+    @classmethod
+    def explain(cls, tx, query, params):
+        plan = tx.run(f"explain {query}", **params).consume().plan
+        operators = []
+        stack = [plan] if plan else []
+        while stack:
+            op = stack.pop()
+            # The plan is an object or a dict depending on the driver version
+            if isinstance(op, dict):
+                operators.append(op.get('operatorType', ''))
+                stack.extend(op.get('children', []))
+            else:
+                operators.append(op.operator_type)
+                stack.extend(op.children)
+
+        return operators
+
+    # Create (or update) a batch of nodes at once and link them to their addresses
+    # The merge uses the nodeKey unique constraint
+    @classmethod
+    def create_node_batch(cls, tx, nodes):
+        tx.run('''
+            unwind $nodes as node
+            merge (n: Node {nodeKey: node.nodeKey})
+            set n.label = node.label, n.nameID = node.nameID, n.dlsrc = node.dlsrc, n.nwksrc = node.nwksrc, n.role = node.role
+            with n, node
+            optional match (n)-[old: HAS_ADDRESS]->()
+            delete old
+            with distinct n, node
+            foreach (dl in node.dlsrc | merge (a: Address {layer: 'dl', value: dl}) merge (n)-[:HAS_ADDRESS]->(a))
+            foreach (nwk in node.nwksrc | merge (a: Address {layer: 'nwk', value: nwk}) merge (n)-[:HAS_ADDRESS]->(a))
+        ''', nodes=nodes)
+
     # Duplicate all nodes that is useful to create independant graph
     # for each layer.
     @classmethod
@@ -68,6 +221,9 @@ class NodesDatabase(object):
          with n as map 
          create (copy:Node {label: $label_dst}) 
          set copy.nameID = map.nameID, copy.dlsrc = map.dlsrc, copy.nwksrc = map.nwksrc, copy.neighbors = map.neighbors, copy.role = map.role
+         with map, copy
+         match (map)-[:HAS_ADDRESS]->(a: Address)
+         create (copy)-[:HAS_ADDRESS]->(a)
          """, label_src=label_src, label_dst=label_dst
          )
     
@@ -77,8 +233,8 @@ class NodesDatabase(object):
     def node_visu_dllink(cls, tx, label):
         tx.run("""
         match ()-[r: dlLink]->() 
-        match (n_src: Node {label: $label}), (n_dst: Node {label: $label}) 
-        where (r.dlsrc in n_src.dlsrc) and r.dldst in n_dst.dlsrc
+        match (:Address {layer: 'dl', value: r.dlsrc})<-[:HAS_ADDRESS]-(n_src: Node {label: $label})
+        match (:Address {layer: 'dl', value: r.dldst})<-[:HAS_ADDRESS]-(n_dst: Node {label: $label})
         merge (n_src)-[:layer2]->(n_dst)""", label=label)
 
     # Simpler view of the nwk graph where only one edge is drew between
@@ -86,8 +242,8 @@ class NodesDatabase(object):
     @classmethod
     def node_visu_nwklink(cls, tx, label):
         tx.run("match ()-[r:nwkLink]->() "
-               "match (n_src: Node {label: $label}), (n_dst: Node {label: $label}) "
-               "where (r.nwksrc in n_src.nwksrc) and r.nwkdst in n_dst.nwksrc "
+               "match (:Address {layer: 'nwk', value: r.nwksrc})<-[:HAS_ADDRESS]-(n_src: Node {label: $label}) "
+               "match (:Address {layer: 'nwk', value: r.nwkdst})<-[:HAS_ADDRESS]-(n_dst: Node {label: $label}) "
                "merge (n_src)-[:layer3]->(n_dst)",
                label=label
         )
@@ -110,23 +266,60 @@ class NodesDatabase(object):
     def node_transmission(cls, tx, properties):
         dlsrc, dldst = properties['dlsrc'], properties['dldst'] 
         tx.run( """
-        match (n_src: Node {label: 2}) 
-        where $dlsrc in n_src.dlsrc 
-        match (n_dst: Node) 
-        where $dldst in n_dst.dlsrc 
+        match (:Address {layer: 'dl', value: $dlsrc})<-[:HAS_ADDRESS]-(n_src: Node {label: 2}) 
+        match (:Address {layer: 'dl', value: $dldst})<-[:HAS_ADDRESS]-(n_dst: Node {label: 2}) 
         create (n_src)-[:dlLink $properties]->(n_dst)""", 
         dlsrc=dlsrc, dldst = dldst, properties=properties)
 
+    # Same as node_transmission for a batch of transmissions at once
+    @classmethod
+    def nodes_transmission(cls, tx, rows):
+        tx.run("""
+        unwind $rows as properties
+        match (:Address {layer: 'dl', value: properties.dlsrc})<-[:HAS_ADDRESS]-(n_src: Node {label: 2}) 
+        match (:Address {layer: 'dl', value: properties.dldst})<-[:HAS_ADDRESS]-(n_dst: Node {label: 2}) 
+        create (n_src)-[r:dlLink]->(n_dst)
+        set r = properties""", 
+        rows=rows)
+
     # Create edges corresponding to the network communications
+    # Only the transmissions after since are processed if it is given
     @classmethod
-    def nwk_transmission(cls, tx, label):  
+    def nwk_transmission(cls, tx, label, since=None):
         tx.run("match ()-[r_g2:dlLink]->() "
-               "match (n_src: Node {label: $label}), (n_dst: Node {label: $label}) "
-               "where (r_g2.dlsrc in n_src.dlsrc and r_g2.nwksrc in n_src.nwksrc) and r_g2.nwkdst in n_dst.nwksrc "
+               "where $since is null or r_g2.timestamp > $since "
+               "match (:Address {layer: 'dl', value: r_g2.dlsrc})<-[:HAS_ADDRESS]-(n_src: Node {label: $label})-[:HAS_ADDRESS]->(:Address {layer: 'nwk', value: r_g2.nwksrc}) "
+               "match (:Address {layer: 'nwk', value: r_g2.nwkdst})<-[:HAS_ADDRESS]-(n_dst: Node {label: $label}) "
                "create (n_src)-[r:nwkLink { timestamp: r_g2.timestamp, dlsrc: r_g2.dlsrc, dldst: r_g2.dldst, nwksrc: r_g2.nwksrc, nwkdst: r_g2.nwkdst, apptype: r_g2.apptype, data: r_g2.data} ]->(n_dst)",
-               label=label
+               label=label, since=since
         )
 
+    # Timestamps of the transmissions between each pair of addresses
+    # Return the (srcID, nwksrc, dstID, nwkdst, timestamps) rows
+    # Only the transmissions after since, or the ones of the given nodes,
+    # are read if since or nodes is given
+    @classmethod
+    def nwk_conversations(cls, tx, since=None, nodes=None):
+        if nodes is None:
+            links = """
+            match ()-[r_g3:nwkLink]->()
+            where $since is null or r_g3.timestamp > $since
+            """
+        else:
+            links = """
+            match (n: Node {label: 3})-[r_g3:nwkLink]-()
+            where n.nameID in $nodes
+            with distinct r_g3
+            """
+
+        return tx.run(links + """
+        match (:Address {layer: 'nwk', value: r_g3.nwksrc})<-[:HAS_ADDRESS]-(n_src: Node {label: 3})
+        match (:Address {layer: 'nwk', value: r_g3.nwkdst})<-[:HAS_ADDRESS]-(n_dst: Node {label: 3})
+        with n_src.nameID as srcID, n_dst.nameID as dstID, r_g3.nwksrc as nsrc , r_g3.nwkdst as mdst, r_g3.timestamp as tp order by tp
+        where $nodes is null or srcID in $nodes or dstID in $nodes
+        return srcID, nsrc, dstID, mdst, collect(distinct tp)
+        """, since=since, nodes=nodes).values()
+
     @classmethod
     def transport_transmission_part1(cs, tx, delta):
         #delta = .6 # It is the time delta between a request and the response
@@ -143,188 +336,204 @@ class NodesDatabase(object):
         # return n_src.nameID, nsrc, mdst, collect(distinct tp)
         # """).values()
 
-        results = tx.run("""
-        match ()-[r_g3:nwkLink]->()
-        match (n_src: Node {label: 3}), (n_dst: Node {label: 3})
-        where (r_g3.nwksrc in n_src.nwksrc) and r_g3.nwkdst in n_dst.nwksrc
-        with n_src.nameID as srcID, n_dst.nameID as dstID, r_g3.nwksrc as nsrc , r_g3.nwkdst as mdst, r_g3.timestamp as tp order by tp
-        return srcID, nsrc, dstID, mdst, collect(distinct tp)
-        """).values()
+        results = cs.nwk_conversations(tx)
 
-        transNodes = {}
-        dstNodes = {}
         label=4
-        
-        for line in results:
-            srcID, srcN, dstID, dstN, txG = line
-            dstNodes = {
-                dstID: txG
-            }
-            if srcID in transNodes.keys():
-                transNodes[srcID].update(dstNodes)
-            else:
-                transNodes[srcID] = dstNodes
-                transNodes[srcID]['id'] = srcID
-                transNodes[srcID]['role'] = []
+        transNodes = layers.group_transmissions(results)
 
         # logging.debug(transNodes)
-                
-        for src in transNodes.keys():
-            for dst in transNodes[src].keys():
-                if 'role' == dst or 'id' == dst:
-                    continue
-                    
-                # Communication are only one-way
-                source = src
-                sink = dst
-                
-                # Dst only received so Dst is a sink
-                # And so we are a one way communication
-                if not dst in transNodes.keys():
-                    if 'source' not in transNodes[src]['role']:
-                        transNodes[src]['role'].append('source')
-                    srcRole = list(set(transNodes[src]['role']))
-                    dstRole = ['sink']
-                    tx.run("""
-                    match (n: Node{label: $label}), (m: Node{label: $label})
-                    where $srcID = n.nameID and $dstID = m.nameID
-                    merge (n)-[: TRANSEdge {nwksrc: n.nwksrc, nwkdst: m.nwksrc, timestamp: $ts}]->(m)
-                    on create set n.role = n.role + $srcRole, m.role = m.role + $dstRole
-                    """, label=label, srcID=source, dstID=sink, srcRole=srcRole, dstRole=dstRole, ts=transNodes[source][sink])
-
-                # here we have a one-way communication src to dst
-                elif src not in transNodes[dst].keys():
-                    if 'source' not in transNodes[src]['role']:
-                        transNodes[src]['role'].append('source')
-                    if 'sink' not in transNodes[dst]['role']:
-                        transNodes[dst]['role'].append('sink')
-                        
-                    srcRole = list(set(transNodes[src]['role']))
-                    dstRole = list(set(transNodes[dst]['role']))
-                    tx.run("""
-                    match (n: Node{label: $label}), (m: Node{label: $label})
-                    where $srcID = n.nameID and $dstID = m.nameID
-                    merge (n)-[: TRANSEdge {nwksrc: n.nwksrc, nwkdst: m.nwksrc, timestamp: $ts}]->(m)
-                    on create set n.role = $srcRole, m.role = $dstRole
-                    """, label=label, srcID=source, dstID=sink, srcRole = srcRole, dstRole = dstRole, ts=transNodes[source][sink])
-
-                # bidirectional communications
-                else:
-                    tx1 = transNodes[src][dst]
-                    tx2 = transNodes[dst][src]
-
-                    lentx1 = len(tx1)
-                    lentx2 = len(tx2)
-
-                    #j = 0
-                    for t2 in tx2:
-                        #for i in range(j, lentx1):
-                        for t1 in tx1:
-                            #t1 = tx1[i]
-                            if t2 > t1 :
-                                if t2 - t1 < delta:
-
-                                    #logging.debug(f'TRANSEdge created: {dst} -> {src} with {t2} - {t1}')
-                                    
-                                    if 'source' not in transNodes[dst]['role']:
-                                        transNodes[dst]['role'].append('source')
-                                    if 'sink' not in transNodes[src]['role']:
-                                        transNodes[src]['role'].append('sink')
-                                    source = dst
-                                    sink = src
-                                    srcRole = list(set(transNodes[source]['role']))
-                                    dstRole = list(set(transNodes[sink]['role']))
-                                    tx.run("""
-                                    match (n: Node{label: $label}), (m: Node{label: $label})
-                                    where $srcID = n.nameID and $dstID = m.nameID
-                                    merge (n)-[: TRANSEdge {timestamp: $ts, nwksrc: n.nwksrc, nwkdst: m.nwksrc}]->(m)
-                                    on create set n.role=$srcRole, m.role=$dstRole
-                                    """, label=label, srcID=source, dstID=sink, srcRole=srcRole, dstRole=dstRole, ts=tx2)
-                                    #j = i
-                                    #break
-                            else:
-                                continue
-
-    @classmethod
-    def transport_transmission_part2(cs, tx, delta):
-        #Let's create controller
-        results = tx.run("""
+
+        for source, sink, srcRole, dstRole, ts, append in layers.request_responses(transNodes, delta):
+            if append:
+                tx.run("""
+                match (n: Node{label: $label}), (m: Node{label: $label})
+                where $srcID = n.nameID and $dstID = m.nameID
+                merge (n)-[: TRANSEdge {nwksrc: n.nwksrc, nwkdst: m.nwksrc, timestamp: $ts}]->(m)
+                on create set n.role = n.role + $srcRole, m.role = m.role + $dstRole
+                """, label=label, srcID=source, dstID=sink, srcRole=srcRole, dstRole=dstRole, ts=ts)
+            else:
+                tx.run("""
+                match (n: Node{label: $label}), (m: Node{label: $label})
+                where $srcID = n.nameID and $dstID = m.nameID
+                merge (n)-[: TRANSEdge {nwksrc: n.nwksrc, nwkdst: m.nwksrc, timestamp: $ts}]->(m)
+                on create set n.role = $srcRole, m.role = $dstRole
+                """, label=label, srcID=source, dstID=sink, srcRole=srcRole, dstRole=dstRole, ts=ts)
+
+        # Roles before the controllers are found
+        tx.run("match (n: Node{label: 4}) set n.transRole = n.role")
+
+    # Paths src -> ctrl -> sink where ctrl can forward the messages of src,
+    # followed by the nameID of the node in the middle of the path
+    # Only the paths through the nodes of middles are given if it is set
+    @classmethod
+    def controller_paths(cs, tx, middles=None):
+        return tx.run("""
         match (n: Node{label: 4})-[r1]-(m: Node{label: 4})-[r2]-(d: Node{label: 4})
-        where ('source' in n.role or 'controller' in n.role) and ('source' in m.role and 'sink' in m.role) and ('sink' in d.role or 'controller' in d.role) and n <> d
-        with r1.nwksrc as src, r1.nwkdst as ctrl, r2.nwkdst as sink, r1.timestamp as ts1, r2.timestamp as ts2
-        return src, ctrl, sink, ts1, ts2
-        """).values()
+        where ($middles is null or m.nameID in $middles)
+        and ('source' in n.transRole or 'controller' in n.transRole) and ('source' in m.transRole and 'sink' in m.transRole) and ('sink' in d.transRole or 'controller' in d.transRole) and n <> d
+        with r1.nwksrc as src, r1.nwkdst as ctrl, r2.nwkdst as sink, r1.timestamp as ts1, r2.timestamp as ts2, m.nameID as mid
+        return src, ctrl, sink, ts1, ts2, mid
+        """, middles=middles).values()
+
+    # Controllers found on the paths through each node, kept for transport_update
+    @classmethod
+    def set_forwarded(cs, tx, found):
+        tx.run("""
+        unwind $found as f
+        match (n: Node{label: 4})
+        where n.nameID = f.nameID
+        set n.forwarded = f.ctrls
+        """, found=[{'nameID': nameID, 'ctrls': ctrls} for nameID, ctrls in found.items()])
+
+    @classmethod
+    def transport_transmission_part2(cs, tx, delta, controllersFile=None):
+        #Let's create controller
+        results = cs.controller_paths(tx)
 
         #delta2 = .7
-        delta = delta
+        forwarded = layers.forwarded_transmissions(results, delta)
+        toreturn, controllers = layers.controller_results(forwarded, controllersFile)
 
-        toreturn = []
-        toprint = ""
-
-        for line in results:
-            source, controller, sink, ts1, ts2 = line
-
-            if isinstance(controller, list):
-                controller = controller[0]      
-            
-            for t2 in ts2:
-                for t1 in ts1:
-                # we get a controller
-                    if t2 > t1 and t2 - t1 < delta:
-
-                        
-                        toreturn.append([source, [str(t1)], [controller], [str(t2)], sink])
-                        toprint+=f"{source}, [{t1}], [{controller}], [{t2}], {sink}\n"
-                        
-                        tx.run("""
-                        match (n: Node{label: 4})
-                        where $ctrl in n.nwksrc
-                        set n.role = ['controller']
-                        """, ctrl=controller)
-    
-        with open("tests/controller-legit.txt", 'w') as outputFile:
-            outputFile.write(f"{toprint}")
+        tx.run("match (n: Node{label: 4}) set n.forwarded = []")
+        cs.set_forwarded(tx, layers.forwarded_by(results, delta))
+
+        # All controllers are set at once
+        tx.run("""
+        match (n: Node{label: 4})
+        where any(ctrl in $ctrls where ctrl in n.nwksrc)
+        set n.role = ['controller']
+        """, ctrls=controllers)
 
         return toreturn
+
     # Create edges corresponding to the application communications
     # Currently only support AS scheme
+    # The paths source -> controller -> sink are searched by layers.interactions
+    # from the edges of the transport graph, maxHops bounds their length
     @classmethod
-    def application_transmission(cs, tx, delta):
+    def application_transmission(cs, tx, delta, maxHops=None):
         #delta = 1.5
-        delta = delta
+        roles, edges = cs.transport_graph(tx)
+        pairs = layers.interactions(roles, edges, delta, maxHops)
+        cs.merge_interactions(tx, pairs)
 
-        # Select all nodes and edges (here represented by path p) that are involved 
-        # in an actuator-sensor scheme.
-        results = tx.run("""
-        match p=(n:Node{label: 4})-[:TRANSEdge*1..]->(c: Node{label: 4})-[:TRANSEdge*1..]->(m:Node{label: 4})
-        where 'source' in n.role and 'sink' in m.role and n <> m and 'controller' in c.role
-        return p
-        """)
+    # Roles ({nameID: role}) and (src, dst, timestamps) edges of the transport graph
+    @classmethod
+    def transport_graph(cs, tx):
+        roles = dict(tx.run("""
+        match (n: Node{label: 4})
+        return n.nameID, n.role
+        """).values())
+
+        edges = tx.run("""
+        match (n: Node{label: 4})-[r: TRANSEdge]->(m: Node{label: 4})
+        return n.nameID, m.nameID, r.timestamp
+        """).values()
 
-        for result in results:
-            nbRel = len(result["p"].relationships)
-            rel = result["p"].relationships
-            count = 1
-            for i in range(1, nbRel):
-                TX1 = rel[i - 1]['timestamp']
-                TX2 = rel[i]['timestamp']
-                for t2, t1 in ((tx2, tx1) for tx2 in TX2 for tx1 in TX1):
-                    if t2 > t1 and t2 - t1 < delta:
-                        count += 1
-                        break
-                    
-
-            #logging.debug(f'Count: {count} and nbRel: {nbRel}')
-            # All relationships are succeeded
-            if count == nbRel:
-                source, dest1 = rel[0].nodes
-                dest1, sink = rel[-1].nodes
-                
-                tx.run("""
-                match (n: Node{label: 5}), (m: Node{label: 5})
-                where n.nameID = $nameIdn and m.nameID = $nameIdm
-                Merge (n)-[: INTERACT {nwksrc: n.nwksrc, nwkdst: m.nwksrc}]->(m)
-                """, nameIdn=source['nameID'], nameIdm=sink['nameID'])
+        return roles, edges
+
+    # One INTERACT edge per (source, sink)
+    @classmethod
+    def merge_interactions(cs, tx, pairs):
+        tx.run("""
+        unwind $pairs as pair
+        match (n: Node{label: 5}), (m: Node{label: 5})
+        where n.nameID = pair[0] and m.nameID = pair[1]
+        Merge (n)-[: INTERACT {nwksrc: n.nwksrc, nwkdst: m.nwksrc}]->(m)
+        """, pairs=[list(pair) for pair in pairs])
+
+    # Process again the pairs of nodes with transmissions after since:
+    # their TRANSEdges are replaced and the roles of their nodes computed
+    # from all the transmissions of the nodes (see layers.transport_update).
+    # The controllers are searched again through these nodes and their
+    # neighbors if delta2 is given.
+    # Return the nodes whose edges or roles changed
+    @classmethod
+    def transport_update(cs, tx, since, delta, delta2=None):
+        between = {frozenset((line[0], line[2])) for line in cs.nwk_conversations(tx, since=since)}
+        nodes = set().union(*between)
+        pairs = layers.conversation_pairs(cs.nwk_conversations(tx, nodes=list(nodes)))
+        edges, transRoles = layers.transport_update(pairs, nodes, between, delta)
+
+        tx.run("""
+        unwind $pairs as pair
+        match (n: Node{label: 4})-[r: TRANSEdge]-(m: Node{label: 4})
+        where n.nameID = pair[0] and m.nameID = pair[1]
+        delete r
+        """, pairs=[[min(pair), max(pair)] for pair in between])
+
+        tx.run("""
+        unwind $edges as edge
+        match (n: Node{label: 4}), (m: Node{label: 4})
+        where n.nameID = edge[0] and m.nameID = edge[1]
+        merge (n)-[: TRANSEdge {nwksrc: n.nwksrc, nwkdst: m.nwksrc, timestamp: edge[2]}]->(m)
+        """, edges=[list(edge) for edge in edges])
+
+        tx.run("""
+        unwind $roles as r
+        match (n: Node{label: 4})
+        where n.nameID = r.nameID
+        set n.transRole = r.role
+        """, roles=[{'nameID': nameID, 'role': role} for nameID, role in transRoles.items()])
+
+        controllers = []
+        if delta2 is not None:
+            middles = tx.run("""
+            match (n: Node{label: 4})
+            where n.nameID in $nodes
+            optional match (n)-[: TRANSEdge]-(m: Node{label: 4})
+            return collect(distinct n.nameID) + collect(distinct m.nameID)
+            """, nodes=list(nodes)).single()[0]
+            middles = list(set(middles))
+            found = layers.forwarded_by(cs.controller_paths(tx, middles), delta2)
+            cs.set_forwarded(tx, {nameID: found.get(nameID, []) for nameID in middles})
+
+            controllers = tx.run("""
+            match (n: Node{label: 4})
+            unwind coalesce(n.forwarded, []) as ctrl
+            return collect(distinct ctrl)
+            """).single()[0]
+
+        changed = tx.run("""
+        match (n: Node{label: 4})
+        with n, case when any(ctrl in $ctrls where ctrl in n.nwksrc) then ['controller'] else n.transRole end as role
+        where not (all(x in role where x in n.role) and all(x in n.role where x in role))
+        set n.role = role
+        return n.nameID
+        """, ctrls=controllers).values()
+
+        nameIDs = tx.run("""
+        match (n: Node{label: 4})
+        where n.nameID in $nodes
+        return n.nameID
+        """, nodes=list(nodes)).values()
+
+        return set(line[0] for line in changed + nameIDs)
+
+    # Search again the interactions from the sources with a path to the
+    # given nodes, their INTERACT edges are replaced
+    # Return these sources
+    @classmethod
+    def interact_update(cs, tx, nodes, delta, maxHops=None):
+        tx.run("""
+        unwind $nodes as nameID
+        match (n: Node{label: 4}), (c: Node{label: 5})
+        where n.nameID = nameID and c.nameID = nameID
+        set c.role = n.role
+        """, nodes=list(nodes))
+
+        roles, edges = cs.transport_graph(tx)
+        starts = layers.reaching(edges, nodes)
+
+        tx.run("""
+        match (n: Node{label: 5})-[r: INTERACT]->()
+        where n.nameID in $starts
+        delete r
+        """, starts=list(starts))
+
+        cs.merge_interactions(tx, layers.interactions(roles, edges, delta, maxHops, starts))
+
+        return starts
 
 
     ####
@@ -332,23 +541,32 @@ class NodesDatabase(object):
     ####
 
     # Call the trans_transmission_part{1,2} function to store all the communications
-    # between nodes
-    def transGraph(self, delta, delta2=None):
+    # between nodes. The transmissions forwarded by the controllers are
+    # written in controllersFile if it is given
+    def transGraph(self, delta, delta2=None, controllersFile=None):
         ret = None
         with self._driver.session() as session:
             session.write_transaction(self.duplicate_node, 2, 4)
             session.write_transaction(self.transport_transmission_part1, delta)
             if not delta2 is None:
-                ret = session.write_transaction(self.transport_transmission_part2, delta2)
+                ret = session.write_transaction(self.transport_transmission_part2, delta2, controllersFile)
 
             return ret
 
+    # Delays of the transmissions forwarded by the controllers, once the
+    # transport graph is built without controllers (see layers.controller_thresholds)
+    def controllerThresholds(self, maxDelta):
+        with self._driver.session() as session:
+            results = session.read_transaction(self.controller_paths)
+
+        return layers.controller_thresholds(results, maxDelta)
+
     # Call the trans_transmission function to store all the communications
     # between nodes
-    def appGraph(self, delta):
+    def appGraph(self, delta, maxHops=None):
         with self._driver.session() as session:
             session.write_transaction(self.duplicate_node, 4, 5)
-            session.write_transaction(self.application_transmission, delta)
+            session.write_transaction(self.application_transmission, delta, maxHops)
 
     # Call the nwk_transmission function to store all the communications
     # between nodes
@@ -359,27 +577,148 @@ class NodesDatabase(object):
 
             session.write_transaction(self.node_visu_nwklink, 'l2')
 
-    # Call the node_transmission function to store all the communications
-    # between nodes
-    def create_nodesTX(self, nodesTX):
+    # Update the network graph with the transmissions after since
+    # The visual nodes are not updated
+    def nwkAppend(self, since):
         with self._driver.session() as session:
-            for t in nodesTX:
-                session.write_transaction(self.node_transmission, nodesTX[t])
+            session.write_transaction(self.duplicate_missing_node, 2, 3)
+            session.write_transaction(self.nwk_transmission, 3, since)
 
-            session.write_transaction(self.duplicate_node, 2, 'l2')
-            session.write_transaction(self.node_visu_dllink, 'l2')
+    # Update the transport graph with the transmissions after since
+    # Return the nodes whose edges or roles changed
+    def transAppend(self, since, delta, delta2=None):
+        with self._driver.session() as session:
+            session.write_transaction(self.duplicate_missing_node, 2, 4)
+            session.run("match (n: Node{label: 4}) where n.transRole is null set n.transRole = n.role")
+            return session.write_transaction(self.transport_update, since, delta, delta2)
+
+    # Update the application graph once the given nodes changed
+    def appAppend(self, nodes, delta, maxHops=None):
+        with self._driver.session() as session:
+            session.write_transaction(self.duplicate_missing_node, 4, 5)
+            return session.write_transaction(self.interact_update, nodes, delta, maxHops)
+
+    # Timestamp of the last transmission processed by each layer
+    def watermarks(self):
+        with self._driver.session() as session:
+            return session.read_transaction(self.get_watermarks)
+
+    def set_watermark(self, label, timestamp):
+        with self._driver.session() as session:
+            session.write_transaction(self.merge_watermark, label, timestamp)
+
+    # Call the nodes_transmission function to store all the communications
+    # between nodes, batchSize transmissions per transaction
+    # The visual nodes are only built if visu is True
+    def create_nodesTX(self, nodesTX, batchSize=None, visu=True):
+        batchSize = DEFAULT_BATCH_SIZE if batchSize is None else int(batchSize)
+        rows = list(nodesTX.values())
+
+        start = time.time()
+        with self._driver.session() as session:
+            for i in range(0, len(rows), batchSize):
+                session.write_transaction(self.nodes_transmission, rows[i:i + batchSize])
+
+            elapsed = time.time() - start
+            logging.info(f"[i] {len(rows)} transmissions imported in {elapsed:.2f}s ({len(rows) / elapsed if elapsed else 0:.0f} rows/s)")
+
+            if visu:
+                session.write_transaction(self.duplicate_node, 2, 'l2')
+                session.write_transaction(self.node_visu_dllink, 'l2')
 
     # Handle the creation of multiple nodes
-    # using the neo4j syntax
+    # using the neo4j syntax, all nodes are created in a single transaction
     def create_nodes(self, nodes):
+        rows = []
+        for nameID, dlsrc, nwksrc, label, role in nodes:
+            # Several addresses can be given in a single string separated by ';'
+            if isinstance(dlsrc, str):
+                dlsrc = dlsrc.split(';')
+            if isinstance(nwksrc, str):
+                nwksrc = nwksrc.split(';')
+
+            rows.append({
+                'nodeKey': f'{label}:{nameID}',
+                'label': label,
+                'nameID': nameID,
+                'dlsrc': dlsrc,
+                'nwksrc': nwksrc,
+                'role': role
+            })
+
+        # The merge relies on the nodeKey constraint
+        self.bootstrap()
         with self._driver.session() as session:
-            for n in nodes:
-                session.write_transaction(self.create_node, n)
+            session.write_transaction(self.create_node_batch, rows)
+
+    # Create the indexes and constraints needed by the layer queries
+    # Nothing is done if the database already has the current schema version
+    def bootstrap(self):
+        with self._driver.session() as session:
+            version = session.read_transaction(self.schema_version)
+            if version >= SCHEMA_VERSION:
+                logging.debug(f"[i] Database schema is up to date (version {version})")
+                return False
+
+            # The nodes must have their nodeKey before the constraint is created
+            if version < 1:
+                self.migrate_nodes(session)
+
+            for statement in SCHEMA:
+                session.write_transaction(self.schema_statement, statement)
+            session.write_transaction(self.set_schema_version, SCHEMA_VERSION)
+            logging.info(f"[i] Database schema upgraded from version {version} to {SCHEMA_VERSION}")
+
+            return True
+
+    # Upgrade the nodes created before the schema version 1 (see SCHEMA), the
+    # addresses of a node are a list or a single string separated by ';'
+    # Without it, the queries joined on the Address nodes match nothing
+    def migrate_nodes(self, session):
+        nodes = []
+        for nodeID, label, nameID, dlsrc, nwksrc in session.read_transaction(self.unmigrated_nodes):
+            if isinstance(dlsrc, str):
+                dlsrc = dlsrc.split(';')
+            if isinstance(nwksrc, str):
+                nwksrc = nwksrc.split(';')
+
+            # Like create_nodes, only the nodes of the dl graph have a nodeKey
+            nodes.append({
+                'id': nodeID,
+                'nodeKey': f'{label}:{nameID}' if label == 2 else None,
+                'dlsrc': dlsrc or [],
+                'nwksrc': nwksrc or []
+            })
+
+        if nodes:
+            session.write_transaction(self.migrate_node_batch, nodes)
+            logging.info(f"[i] {len(nodes)} nodes linked to their addresses")
+
+    # Check that the lookups of the layer queries use an index seek, and that
+    # the nodes of the dl graph have their nodeKey and Address nodes
+    # Return a list of (name, ok, operators)
+    def check_schema(self):
+        report = []
+        with self._driver.session() as session:
+            for name, query, params in SCHEMA_CHECKS:
+                operators = session.read_transaction(self.explain, query, params)
+                ok = any('IndexSeek' in op for op in operators)
+                if not ok:
+                    logging.warning(f"[w] {name} doesn't use an index: {', '.join(operators)}")
+                report.append((name, ok, operators))
+
+            unlinked = session.read_transaction(self.unlinked_nodes)
+            if unlinked:
+                logging.warning(f"[w] {unlinked} nodes have no nodeKey or no Address, they were created before the schema version {SCHEMA_VERSION}")
+            report.append(("Node addresses", unlinked == 0, [f"{unlinked} nodes without nodeKey or Address"]))
+
+        return report
 
     def del_nodes(self, label, mode):
         with self._driver.session() as session:
             if 'node' in mode:
                 session.write_transaction(self.delete_nodes, label)
+                session.write_transaction(self.delete_watermarks, label)
             else:
                 session.write_transaction(self.delete_visu_nodes, label)
 
@@ -393,6 +732,21 @@ class NodesDatabase(object):
              """).values()
         return values
 
+    # Nodes of the data link layer and transmissions of the network layer
+    # (see MemoryDatabase.load_nwk)
+    def nwkSnapshot(self):
+        with self._driver.session() as session:
+            nodes = session.run("""
+                match (n: Node {label: 2})
+                return n.nameID, n.dlsrc, n.nwksrc, n.role
+                """).values()
+            links = session.run("""
+                match (n: Node {label: 3})-[r: nwkLink]->(m: Node {label: 3})
+                return n.nameID, m.nameID, properties(r)
+                """).values()
+
+        return {'nodes': nodes, 'links': links}
+
     def getNodes(self):
         with self._driver.session() as session:
             nodes = session.run("""
@@ -425,13 +779,15 @@ class NodesDatabase(object):
     def removeTX(self, label):
         with self._driver.session() as session:
             session.write_transaction(self.delete_transmissions, label)
+            session.write_transaction(self.delete_watermarks, label)
         
     def removeNode(self, nodeID):
         with self._driver.session() as session:
             ret = session.run("""
                 MATCH (n:Node)
                 where n.nameID = $nodeID
-                delete n
+                detach delete n
                 """, nodeID = nodeID).values()
+            session.write_transaction(self.delete_orphan_addresses)
 
         return ret
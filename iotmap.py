@@ -3,7 +3,7 @@
 IoTMap
 
 Usage: 
-    iotmap.py [ database [--import_pcap <pcapfile> <protocol> | --clear_database | --export_db <path> | --import_db <path>]
+    iotmap.py [--backend <backend>] [ database [--import_pcap <pcapfile> <protocol> | --clear_database | --export_db <path> | --import_db <path>]
               | sniffing [--channel <channel>] [--timeout <timeout>] [--packetnb <packetnb>] [--protocol <protocol>] [--nbthread <nbthread>] [--output <filename>]
               | exploit 
               | modelling [--level <level>] ]
@@ -11,6 +11,8 @@ Usage:
 Options: 
     -h, --help                           Show this help menu.
     -v, --version                        Show version.
+    -b, --backend <backend>              Where the graphs are stored: neo4j or memory (no database
+                                         server, the graphs are lost on exit) [default: neo4j].
 
     database                             Use database mode.
     --clear_database                     Clear the current database
@@ -59,7 +61,7 @@ class IoTMap:
             complete_while_typing=True
         )
 
-        self.dc = DBController()
+        self.dc = DBController(args['--backend'])
         self.options = self.get_options()
         
         self.contexts = [
@@ -218,18 +220,23 @@ IIIIIIIIII   ooooooooooo      TTTTTTTTTTT      MMMMMMMM               MMMMMMMM
                                 Version={version}
 """		
     args = docopt(__doc__, version=version)
-    
-    command = "./database/neo4j-community/bin/neo4j start"
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    # The memory backend doesn't need the neo4j server
+    useNeo4j = args['--backend'] == 'neo4j'
+
+    if useNeo4j:
+        command = "./database/neo4j-community/bin/neo4j start"
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
     
     print(banner)
-    wait_until_DB_is_UP()
+    if useNeo4j:
+        wait_until_DB_is_UP()
 
     # print('Database is available at http://localhost:7474/ \n')
     iotmap = IoTMap()
     iotmap()
     
-    command = "./database/neo4j-community/bin/neo4j stop"
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
+    if useNeo4j:
+        command = "./database/neo4j-community/bin/neo4j stop"
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
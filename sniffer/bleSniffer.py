@@ -40,7 +40,24 @@ from btlejack.link import DeviceError
 from btlejack.version import VERSION
 from btlejack.session import BtlejackSession, BtlejackSessionError
 
+# Link types of the pcap writers of btlejack
+LINKTYPE_BLUETOOTH_LE_LL = 251
+LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR = 256
+LINKTYPE_NORDIC_BLE = 272
+
+# Pcap writer that also pushes the frames it writes to the queue of the
+# sniffer in streaming mode (see Sniffer.push)
+def streamWriter(writer, sniffer, linktype):
+    class StreamWriter(writer):
+        def write_packet(self, ts_sec, ts_usec, aa, packet):
+            super().write_packet(ts_sec, ts_usec, aa, packet)
+            sniffer.push(linktype, self.payload(aa, packet), ts_sec + ts_usec / 1000000)
+
+    return StreamWriter
+
 class bleSniffer(Sniffer):
+    protocol = 'BTLE'
+
     # def __init__(self, output, output_format, devices=None, crc=None, chm=None,
     #              hop=None, verbose=True, timeout=0, hijack=None, jamming=None):
     def __init__(self, options):
@@ -88,11 +105,15 @@ class bleSniffer(Sniffer):
         output_format = 'll_phdr'
 
         if output_format.lower().strip() == 'nordic':
-            self.output = PcapNordicTapWriter(output)
+            writer, linktype = PcapNordicTapWriter, LINKTYPE_NORDIC_BLE
         elif output_format.lower().strip() == 'll_phdr':
-            self.output = PcapBlePHDRWriter(output)
+            writer, linktype = PcapBlePHDRWriter, LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR
         else:
-            self.output = PcapBleWriter(output)
+            writer, linktype = PcapBleWriter, LINKTYPE_BLUETOOTH_LE_LL
+
+        if self.frames is not None:
+            writer = streamWriter(writer, self, linktype)
+        self.output = writer(output)
 
 
         if self.type == 'sniff':
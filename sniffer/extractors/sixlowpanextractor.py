@@ -74,27 +74,27 @@ def hex_to_string(address):
         
     return string[:-1]
 
+# Key identifying the retransmissions of a CoAP message, None if the
+# packet is not a CoAP GET, POST or 2.05 Content message
+def coapKey(x):
+    if CoAP in x and (x.code==1 or x.code==2 or x.code==69):
+        return (x.msg_id, x.code)
+    return None
+
+# Remove the retransmissions of CoAP messages
+# For each (msg_id, code), only the packet with the latest timestamp is kept.
+# pkts is read only once, so it can be a stream of packets (e.g. a PcapReader)
+# and only the kept packets are stored. Packets are returned ordered by timestamp.
 def cleanCoAPPcap(pkts):
-    coapPkts = []
-    MID = []
+    latest = {}
     
     for x in pkts:
-        if CoAP in x and (x.code==1 or x.code==2 or x.code==69):
-            coapPkts.append(x)
-            MID.append(x.msg_id)
-
-    MID = list(set(MID))
-
-    f_pkts = []
-
-    for mid in MID:
-        for c in [1, 2, 69]:
-            pkt = [x for x in coapPkts if x.msg_id == mid and x.code==c]
-            if len(pkt) > 0 :
-                pkt.sort(key=lambda x: x.time)
-            else :
-                continue
-            f_pkts.append(pkt[-1])
+        key = coapKey(x)
+        if key is not None and (key not in latest or x.time >= latest[key].time):
+            latest[key] = x
+
+    f_pkts = list(latest.values())
+    f_pkts.sort(key=lambda x: x.time)
         
     return f_pkts
 
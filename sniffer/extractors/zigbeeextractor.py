@@ -1,6 +1,6 @@
 from scapy.utils import *
 from utils.crypto.utils import key_net
-from utils.crypto.zigbee_crypto import zigbee_decrypt
+from utils.crypto.zigbee_crypto import ZigbeeDecryptor, ZigbeeKeyRing
 
 from scapy.layers.dot15d4 import *
 from scapy.layers.zigbee import *
@@ -17,11 +17,23 @@ class ZigbeeExtractor():
         key, self.decryption, self.verbose = args
         self.index = 0
         # Get key from utils2 if key unset but decryption wanted
-        if key is None and self.decryption:
+        # key is either a key or a list of keys
+        if not key and self.decryption:
             self.key = key_net
         else:
             self.key = key
 
+        # The key is expanded once for all packets
+        # With a list of keys, a key ring tries each key until the MIC is verified
+        self.decryptor = None
+        if self.decryption:
+            if isinstance(self.key, (list, tuple)) and len(self.key) > 1:
+                self.decryptor = ZigbeeKeyRing(self.key)
+            elif isinstance(self.key, (list, tuple)):
+                self.decryptor = ZigbeeDecryptor(self.key[0])
+            else:
+                self.decryptor = ZigbeeDecryptor(self.key)
+
     def extract_pkt_info(self, pkt):
         """
         Extracts all layers specific information from header.
@@ -232,7 +244,7 @@ class ZigbeeExtractor():
         # Decryption for ZigbeeAppDataPayload / ZigbeeClusterLibrary
         if self.decryption and ZigbeeSecurityHeader in pkt:
             # Decrypt packet
-            decrypted_pkt = zigbee_decrypt(pkt, self.key)
+            decrypted_pkt = self.decryptor.decrypt(pkt)
             ok_decryption, ok_interpretation = True, True
 
             if isinstance(decrypted_pkt, bytes) or decrypted_pkt is None:
@@ -0,0 +1,31 @@
+from binascii import crc_hqx
+from scapy.layers.dot15d4 import Dot15d4FCS
+import logging
+
+# The 802.15.4 FCS is a CRC-16/KERMIT (CRC-CCITT with reflected bits,
+# stored little endian at the end of the frame).
+# binascii.crc_hqx computes the same CRC without the reflection, so the bits
+# of each byte are reversed with a translation table before calling it.
+# Applied to a frame and its FCS, the CRC is 0 if the frame is not corrupt.
+REVERSED_BITS = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+# Return the CRC-16/KERMIT of data
+def crc16_kermit(data: bytes):
+    crc = crc_hqx(data.translate(REVERSED_BITS), 0)
+    return (REVERSED_BITS[crc & 0xff] << 8) | REVERSED_BITS[crc >> 8]
+
+# Check the FCS of a raw 802.15.4 frame (FCS included)
+def check_fcs(s: bytes):
+    return len(s) >= 2 and crc_hqx(s.translate(REVERSED_BITS), 0) == 0
+
+# Return the frames (first layer, raw bytes, timestamp) of a chunk with a
+# valid FCS. Frames read without FCS can't be checked and are kept.
+def valid_frames(frames: list):
+    valid = []
+    for cls, s, t in frames:
+        if issubclass(cls, Dot15d4FCS) and not check_fcs(s):
+            logging.debug(f"Packet[{t}] rejected: bad FCS")
+            continue
+        valid.append((cls, s, t))
+
+    return valid
@@ -2,32 +2,38 @@
 # from extractors import btleextractor, zigbeeextractor
 from .extractors import btleextractor
 from .extractors import bleConstants as bleConstants
+from .prefilters import prefilters
+from . import fcs
 from multiprocessing import Pool
+from threading import Semaphore
+from collections import deque
+import heapq
 import logging
 import csv
-from scapy.utils import raw, rdpcap
-from scapy.layers.dot15d4 import conf
+from scapy.utils import RawPcapReader, RawPcapNgReader
+from scapy.layers.dot15d4 import conf, Dot15d4
 
 # apptype
 # 1 : streaming
 # 2 : sensor
 # 3 : actuator
 
-gpkts = []
+# Number of frames sent to a worker at once
+DEFAULT_CHUNK_SIZE = 1000
+
+# Each process of the pool owns one PacketGenerator per protocol
+# They are created once, the first time a chunk of the protocol is received
+generators = {}
 
 #extractor = zigbeeextractor.ZigbeeExtractor(key_net, True, 1)
 #conf.dot15d4_protocol="zigbee"
 
 class PacketGenerator():
-    def __init__(self, protocol, pkts_size, nbThread, verbose):
+    def __init__(self, protocol, verbose, keys=None):
         self.protocol = protocol
-        self.pkts_size = pkts_size
         self.verbose = verbose
-        self.nbThread = nbThread
-        self.BTLEAddr = {
-            'Slave': 'Slave',
-            'Master': 'Master'
-        }
+        # ZigBee network keys, the default key is used if None
+        self.keys = keys
 
         # List of supported protocols
         self.protocols = {
@@ -48,7 +54,7 @@ class PacketGenerator():
             from .extractors import zigbeeextractor
             self.extractors['ZIGBEE'] = {
                 'extractor': zigbeeextractor.ZigbeeExtractor,
-                'args': [None, True, self.verbose]
+                'args': [self.keys, True, self.verbose]
             }
 
         elif self.protocol == 'OS4I':
@@ -58,40 +64,32 @@ class PacketGenerator():
                 'args': [self.verbose]
             }
 
+        # Checks run on a whole chunk of raw frames before their dissection
+        self.checks = {
+            'ZIGBEE': fcs.valid_frames
+        }
+
         # Set the extractor and the function to use
         e = self.extractors[protocol]['extractor']
         self.extractor = e(self.extractors[protocol]['args'])
         self.function = self.protocols[protocol]
+        self.check = self.checks.get(protocol)
 
-    def convertPackets(self):
-        logging.info(f'{self.pkts_size} packets will be processed')
-        print(f"type of nbThread: {type(self.nbThread)}")
-        with Pool(int(self.nbThread)) as p:
-        # Rather than set as parameter the packets array
-        # We set an array of index, and we access the array through a global variable
-        # It's a weird way to do it, however it's works
-            rows = p.map(self.function, [i for i in range(0, self.pkts_size)])
-            
-        return rows
-
-    def SixLowPANConversion(self, pkt):
+    def SixLowPANConversion(self, packet):
         """Return a row with the unified format if the packet (input) meets all the requirements  
         
         Extracts information from 6LowPAN packet, analyzes it and converts it to the unified format
         if it corresponds to a data packet with specific information.
         """
-        # This is the little dirty trick
-        # We access to the global variable to get the packet
-        packet = gpkts[pkt]
         row = []
 
         row.append('os4i')
         
         # Print debug
-        logging.debug(f"Packet[{pkt}] processed")
+        logging.debug(f"Packet[{packet.time}] processed")
 
         e = self.extractor.extract_pkt_layers(packet)
-        logging.debug(f"Packet[{pkt}] extracted: {e}")
+        logging.debug(f"Packet[{packet.time}] extracted: {e}")
 
         if e is None:
             return None
@@ -126,24 +124,21 @@ class PacketGenerator():
 
         return row
         
-    def BTLEConversion(self, pkt):
+    def BTLEConversion(self, packet):
         """Return a row with the unified format if the packet (input) meets all the requirements  
         
         Extracts information from BTLE packet, analyzes it and converts it to the unified format
         if it corresponds to a data packet with specific information.
         """
-        # This is the little dirty trick
-        # We access to the global variable to get the packet
-        packet = gpkts[pkt]
         row = []
 
         row.append('btle')
         
         # Print debug
-        logging.debug(f"Packet[{pkt}] processed")
+        logging.debug(f"Packet[{packet.time}] processed")
 
         e = self.extractor.extract_pkt_layers(packet)
-        logging.debug(f"Packet[{pkt}] extracted: {e}")
+        logging.debug(f"Packet[{packet.time}] extracted: {e}")
 
         if 'Master' in e['layer2']['data header']:
             row.append(f"mst-{e['layer2']['data header']['Master']}")
@@ -221,36 +216,25 @@ class PacketGenerator():
         else:
             row.append(e['layer4']['value'])
 
-        logging.debug(f"Packet[{pkt}] : {row}")
+        logging.debug(f"Packet[{packet.time}] : {row}")
         return row
     
-    def ZigBeeConversion(self, pkt):
+    def ZigBeeConversion(self, packet):
         """Return a row with the unified format if the packet (input) meets all the requirements  
         
         Extracts information from ZigBee packet, analyzes it and converts it to the unified format
         if it corresponds to a data packet with specific information.
         """
-        # This is the little dirty trick
-        # We access to the global variable to get the packet
-        #packet = self.pkts[pkt]
-        packet = gpkts[pkt]
-        
         # Print debug
-        logging.debug(f"Packet[{pkt}] processed")
-        # We check if the packet is well formed
-        # And the fcs is correct
-        # So we compute the fcs and compare it to the one store in the packet
-        try:
-            fcs = int.from_bytes(packet.compute_fcs(raw(packet)[:-2]), 'little')
-        except:
-            return None
-        
-        if fcs != packet.fcs:
+        logging.debug(f"Packet[{packet.time}] processed")
+        # The fcs has already been checked on the captured bytes (see valid_frames)
+        # So we only check the packet has been dissected
+        if Dot15d4 not in packet:
             return None
             
         #e = extractor.extract_pkt_info(packet)
         e = self.extractor.extract_pkt_info(packet)
-        logging.debug(f"Packet[{pkt}] extracted: {e}")
+        logging.debug(f"Packet[{packet.time}] extracted: {e}")
         # We are only interested in ZCL Packets
         # So if the packet is an 802.15.4 ACK or DATA
         # then we ignore this packet and only focus on data packets
@@ -337,75 +321,345 @@ class PacketGenerator():
                 else :
                     row.append('get_data')
 
-            logging.debug(f"Packet[{pkt}] : {row}")
+            logging.debug(f"Packet[{packet.time}] : {row}")
             return row
 
-# This function convert a list of packet from a specific protocol to a list
-# of packet using the unified format.
-def gen_packet(pcap: list, protocol: str, nbThread: int, debug: bool):
-    
-    nbThread = nbThread
-    protocol = protocol
-    verbose = debug
-    
-    logging.basicConfig(
-        level=logging.DEBUG if verbose else logging.INFO,
-        format="%(levelname)s:%(message)s"
-    )
-
-    logging.info(f"[i] Pcap from protocol {protocol} will be processed")
-
+# Dissect a raw frame read from a pcap
+# cls is the first layer given by the linktype of the pcap
+def dissect_frame(cls, s, t):
+    try:
+        packet = cls(s)
+    except Exception:
+        packet = conf.raw_layer(s)
+    packet.time = t
+
+    return packet
+
+# Convert a list of raw frames to rows with the unified format
+# Frames are tuples (first layer, raw bytes, timestamp)
+def convert_frames(generator, frames):
+    if generator.check is not None:
+        frames = generator.check(frames)
+
+    rows = []
+    for cls, s, t in frames:
+        row = generator.function(dissect_frame(cls, s, t))
+        # CSV format
+        # timestamp, dlsrc, dldst, nwksrc, nwkdst, apptype, data
+        if row:
+            rows.append(row)
+
+    return rows
+
+# Return the PacketGenerator of the protocol for the current process
+# The dot15d4 protocol is set before each chunk since a single worker
+# can process ZigBee and 6LoWPAN chunks
+def get_generator(protocol, verbose, keys=None):
     if protocol == 'ZIGBEE':
-        from .extractors import zigbeeextractor
         conf.dot15d4_protocol = 'zigbee'
     elif protocol == 'OS4I':
-        from .extractors import sixlowpanextractor
         conf.dot15d4_protocol = 'sixlowpan'
-        
-    try:
-        logging.debug(f"[d] Read Pcap File")
-        pkts = rdpcap(pcap)
-    except:
-        logging.error('Error while opening the file...')
-        logging.error(f'{pcap}')
-        exit(1)
+
+    if (protocol, verbose, keys) not in generators:
+        generators[(protocol, verbose, keys)] = PacketGenerator(protocol, verbose, keys)
+
+    return generators[(protocol, verbose, keys)]
+
+# A task is a chunk of frames from a pcap: (key, protocol, verbose, keys, frames)
+# Only the rows are sent back to the main process
+def convert_task(task):
+    key, protocol, verbose, keys, frames = task
+
+    return key, len(frames), convert_frames(get_generator(protocol, verbose, keys), frames)
+
+# Convert the tasks in a single pool of processes and yield the results
+# as soon as they are available (the order is not kept)
+def convert_tasks(tasks, nbThread: int):
+    nbThread = int(nbThread)
+
+    if nbThread <= 1:
+        for task in tasks:
+            yield convert_task(task)
+        return
+
+    # imap reads the tasks as fast as it can, so we limit the number
+    # of chunks in flight to keep the memory bounded
+    inflight = Semaphore(2 * nbThread)
+    def bounded(tasks):
+        for task in tasks:
+            inflight.acquire()
+            yield task
+
+    with Pool(nbThread) as p:
+        try:
+            for result in p.imap_unordered(convert_task, bounded(tasks)):
+                inflight.release()
+                yield result
+        finally:
+            # Unlock the task handler if we stop before the end
+            for i in range(2 * nbThread):
+                inflight.release()
+
+# Read a pcap (or pcapng) file and yield its frames without dissecting them
+# Each frame is a tuple (first layer, raw bytes, timestamp)
+def read_frames(pcap: str):
+    for linktype, s, t in read_raw_frames(pcap):
+        yield conf.l2types.get(linktype, conf.raw_layer), s, t
+
+# Read the frames of a capture as (link type, raw bytes, timestamp)
+def read_raw_frames(pcap: str):
+    with RawPcapReader(pcap) as reader:
+        for s, meta in reader:
+            if isinstance(reader, RawPcapNgReader):
+                linktype = meta.linktype
+                t = ((meta.tshigh << 32) + meta.tslow) / meta.tsresol
+            else:
+                linktype = reader.linktype
+                t = meta.sec + meta.usec * (1e-9 if reader.nano else 1e-6)
+
+            yield linktype, s, t
+
+# Group an iterable into lists of chunkSize elements
+# Only the current chunk is kept in memory whatever the size of the capture
+def split_chunks(iterable, chunkSize: int):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+# Remove the retransmissions of the CoAP messages of 6LoWPAN frames
+# (first layer, raw bytes, timestamp), the last one of each message is kept
+def clean_retransmissions(frames):
+    from .extractors import sixlowpanextractor
+    conf.dot15d4_protocol = 'sixlowpan'
+    pkts = sixlowpanextractor.cleanCoAPPcap(dissect_frame(*f) for f in frames)
+
+    return [(type(pkt), pkt.original, pkt.time) for pkt in pkts]
+
+# Read a pcap and yield its frames by chunks of chunkSize frames
+# Frames that can't produce a row are dropped by the prefilter of the protocol
+# before being dissected
+def pcap_chunks(pcap: str, protocol: str, chunkSize: int):
+    prefilter = prefilters[protocol]()
+    frames = prefilter.filter(read_frames(pcap))
 
     # Clean the os4i pcap file to remove all retransmissions packets
     # It means remove all messages sent with the same MID in both request and response
+    # Only CoAP packets are kept by the cleaning, so the memory depends on the
+    # number of CoAP messages and not on the capture size
     if 'OS4I' in protocol:
-        logging.info(f"[i] Cleaning Pcap files to erase retransmission communications")
-        pkts = sixlowpanextractor.cleanCoAPPcap(pkts)
-        
-    global gpkts
-    gpkts = pkts
-   
-    genPacket = PacketGenerator(protocol, len(pkts), nbThread, verbose)
+        logging.info(f"[i] Cleaning {pcap} to erase retransmission communications")
+        frames = clean_retransmissions(frames)
+
+    yield from split_chunks(frames, chunkSize)
+
+    logging.info(f"[i] Prefilter {pcap}: {prefilter.report()}")
+
+# This function converts a list of pcaps to rows using the unified format.
+# pcaps is a list of (protocol, pcap). All pcaps are processed at the same
+# time in a single pool: their chunks are interleaved and sent to the workers.
+# Yield (index of the pcap, rows) with the rows of each pcap in order.
+# progress is called with (index, pcap, nbFrames, done) each time a chunk is converted
+# keys is the list of ZigBee network keys to try (the default key if None)
+# backlog is a list with the number of chunks of each pcap sent and not consumed
+# yet: the caller decrements it when it consumes a chunk, and the next chunk
+# sent is the one of the pcap with the smallest backlog. The pcaps are read
+# in turn if None. With a backlog, (index, None) is yielded once a pcap is done.
+def gen_packets_stream(pcaps: list, nbThread: int, debug: bool, chunkSize: int=None, progress=None, keys: list=None, backlog: list=None):
+
+    verbose = debug
+    chunkSize = DEFAULT_CHUNK_SIZE if chunkSize is None else int(chunkSize)
+    keys = tuple(keys) if keys else None
+
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format="%(levelname)s:%(message)s"
+    )
 
-    rows = genPacket.convertPackets()
+    for protocol, pcap in pcaps:
+        logging.info(f"[i] Pcap {pcap} from protocol {protocol} will be processed")
+        try:
+            RawPcapReader(pcap).close()
+        except (IOError, OSError, EOFError):
+            logging.error('Error while opening the file...')
+            logging.error(f'{pcap}')
+            exit(1)
+
+    # Number of chunks of each pcap, known once the pcap is entirely read
+    nbChunks = [None] * len(pcaps)
+
+    # Interleave the chunks of all pcaps so they progress together
+    # The last chunk of each pcap is empty, its result tells the pcap is done
+    def tasks():
+        streams = [[i, protocol, pcap_chunks(pcap, protocol, chunkSize), 0] for i, (protocol, pcap) in enumerate(pcaps)]
+        while len(streams) > 0:
+            if backlog is None:
+                stream = streams.pop(0)
+                streams.append(stream)
+            else:
+                stream = min(streams, key=lambda stream: backlog[stream[0]])
+
+            i, protocol, chunks, seq = stream
+            try:
+                frames = next(chunks)
+            except StopIteration:
+                frames = []
+                nbChunks[i] = seq + 1
+                streams.remove(stream)
+
+            stream[3] += 1
+            if backlog is not None:
+                backlog[i] += 1
+            yield (i, seq), protocol, verbose, keys, frames
+
+    # Results arrive in any order, chunks are buffered
+    # until the previous chunks of the same pcap are received
+    pending = [{} for p in pcaps]
+    nextSeq = [0] * len(pcaps)
+    nbFrames = [0] * len(pcaps)
+
+    for (i, seq), size, rows in convert_tasks(tasks(), nbThread):
+        pending[i][seq] = rows
+        nbFrames[i] += size
+        while nextSeq[i] in pending[i]:
+            yield i, pending[i].pop(nextSeq[i])
+            nextSeq[i] += 1
+            if backlog is not None and nextSeq[i] == nbChunks[i]:
+                yield i, None
+
+        if progress is not None:
+            progress(i, pcaps[i][1], nbFrames[i], nextSeq[i] == nbChunks[i])
+
+    if progress is not None:
+        for i, (protocol, pcap) in enumerate(pcaps):
+            progress(i, pcap, nbFrames[i], True)
+
+    logging.info(f"[i] The process is ending")
+
+# This function converts a pcap from a specific protocol to rows using the
+# unified format. Raw frames are read and sent by chunks of chunkSize frames
+# to the pool, so the peak memory depends on chunkSize and not on the size
+# of the capture.
+def gen_packet_stream(pcap: str, protocol: str, nbThread: int, debug: bool, chunkSize: int=None, keys: list=None):
+    for i, rows in gen_packets_stream([(protocol, pcap)], nbThread, debug, chunkSize, keys=keys):
+        yield rows
+
+# Replace the 'Master' and 'Slave' placeholders of BTLE rows by the addresses
+# of the current connection, i.e. the last connect request seen in the stream.
+# Connect request rows ([protocol, master, slave]) are dropped.
+# Rows received before the first connect request take its addresses, and
+# keep the placeholders if the capture has no connect request.
+# At most limit rows (all of them if None) wait for the first connect
+# request, the older ones keep the placeholders.
+def btle_postprocess(rows, limit: int=None):
+    BTLEAddr = None
+    pending = deque()
+
+    for row in rows:
+        if len(row) == 3:
+            BTLEAddr = btle_connection(row)
+            for r in pending:
+                yield btle_substitute(r, BTLEAddr)
+            pending.clear()
+
+        elif BTLEAddr is None:
+            pending.append(row)
+            if limit is not None and len(pending) > limit:
+                yield pending.popleft()
+        else:
+            yield btle_substitute(row, BTLEAddr)
+
+    for r in pending:
+        yield r
+
+# Addresses of the connection given by a connect request row
+def btle_connection(row):
+    return {
+        'Master': row[1][4:],
+        'Slave': row[2][4:]
+    }
+
+# Only the addresses (dlsrc, dldst, nwksrc, nwkdst) are replaced
+def btle_substitute(row, BTLEAddr):
+    return row[:2] + [BTLEAddr.get(r, r) for r in row[2:6]] + row[6:]
+
+# This function convert a list of packet from a specific protocol to a list
+# of packet using the unified format.
+def gen_packet(pcap: list, protocol: str, nbThread: int, debug: bool, chunkSize: int=None, keys: list=None):
     
-    # CSV format
-    # timestamp, dlsrc, dldst, nwksrc, nwkdst, apptype, data
-    csvData = list(filter(None, rows)) 
+    csvData = []
+    for rows in gen_packet_stream(pcap, protocol, nbThread, debug, chunkSize, keys):
+        csvData += rows
     
     if 'BTLE' in protocol:
-        for row in csvData:
-            if len(row) == 3:
-                genPacket.BTLEAddr['Master'] = row[1][4:]
-                genPacket.BTLEAddr['Slave'] = row[2][4:]
-                while row in csvData:
-                    csvData.remove(row)
-
-    # Let order the list by timestamp
-    # csvData.sort(key=lambda x: x[0])
-    if 'BTLE' in protocol:
-        csvDataTmp = []
-        for row in csvData:
-            row = [r.replace('Slave', genPacket.BTLEAddr['Slave']) if isinstance(r, str) else r for r in row]
-            row = [r.replace('Master', genPacket.BTLEAddr['Master']) if isinstance(r, str) else r for r in row]
-            csvDataTmp.append(row)
-
-        csvData = csvDataTmp
-            
-    logging.info(f"[i] The process is ending")
+        csvData = list(btle_postprocess(csvData))
     
     return csvData
+
+# Rows of a capture are nearly ordered by timestamp: sort them
+# with a sliding window of `window` rows rather than a global sort
+# A row older than the rows already yielded can't be put back in order,
+# the conversion fails rather than writing unordered rows
+def reorder_rows(rows, window: int):
+    heap = []
+    last = None
+    for n, row in enumerate(rows):
+        if last is not None and row[1] < last:
+            raise ValueError(f"Row out of the reorder window of {window} rows, use a larger chunk size: {row}")
+
+        heapq.heappush(heap, (row[1], n, row))
+        if len(heap) > window:
+            last, n, row = heapq.heappop(heap)
+            yield row
+
+    while len(heap) > 0:
+        yield heapq.heappop(heap)[2]
+
+# This function converts all pcaps of pcaps_list ({protocol: [pcaps]})
+# concurrently and yields the rows ordered by timestamp.
+# The rows of each pcap are already ordered, so they are merged with a
+# k-way merge (heap) and never sorted nor loaded all together.
+def gen_packets(pcaps_list: dict, nbThread: int, debug: bool, chunkSize: int=None, progress=None, keys: list=None):
+    pcaps = [(protocol.upper(), pcap) for protocol in pcaps_list.keys() for pcap in pcaps_list[protocol]]
+    window = DEFAULT_CHUNK_SIZE if chunkSize is None else int(chunkSize)
+
+    # The chunks are sent in the order the merge consumes them, so the chunks
+    # received for a pcap while the merge waits for another one are bounded
+    # by the number of chunks in flight
+    backlog = [0] * len(pcaps)
+    stream = gen_packets_stream(pcaps, nbThread, debug, chunkSize, progress, keys, backlog)
+
+    # Chunks of rows received for a pcap while the merge waits for another one
+    buffers = [deque() for p in pcaps]
+    done = [False] * len(pcaps)
+    def rows_of(i):
+        while True:
+            while len(buffers[i]) == 0:
+                if done[i]:
+                    return
+                try:
+                    j, rows = next(stream)
+                except StopIteration:
+                    return
+                if rows is None:
+                    done[j] = True
+                else:
+                    buffers[j].append(rows)
+
+            backlog[i] -= 1
+            yield from buffers[i].popleft()
+
+    outputs = []
+    for i, (protocol, pcap) in enumerate(pcaps):
+        rows = rows_of(i)
+        if 'BTLE' in protocol:
+            rows = btle_postprocess(rows, window)
+        outputs.append(reorder_rows(rows, window))
+
+    # Let order the rows by timestamp
+    return heapq.merge(*outputs, key=lambda x: x[1])
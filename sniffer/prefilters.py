@@ -0,0 +1,171 @@
+from scapy.layers.dot15d4 import Dot15d4, Dot15d4FCS
+from scapy.layers.bluetooth4LE import BTLE, BTLE_RF
+from .extractors import bleConstants
+
+# Prefilters look at the raw bytes of a frame and drop the frames that can't
+# produce a row in the unified format, before the (costly) Scapy dissection.
+# A frame is only dropped when we are sure the conversion would ignore it,
+# every frame that can't be decided from its headers is kept.
+
+class Prefilter():
+    def __init__(self):
+        self.seen = 0
+        self.kept = 0
+        self.drops = {}
+
+    # Return the reason why the frame is dropped, None to keep it
+    def check(self, cls, s):
+        return None
+
+    # Filter a stream of raw frames (first layer, raw bytes, timestamp)
+    def filter(self, frames):
+        for cls, s, t in frames:
+            self.seen += 1
+            reason = self.check(cls, s)
+            if reason is None:
+                self.kept += 1
+                yield cls, s, t
+            else:
+                self.drops[reason] = self.drops.get(reason, 0) + 1
+
+    def report(self):
+        rate = 100 * (self.seen - self.kept) / self.seen if self.seen else 0
+        drops = ', '.join(f"{reason}: {nb}" for reason, nb in sorted(self.drops.items(), key=lambda x: -x[1]))
+        return f"{self.kept}/{self.seen} frames kept ({rate:.1f}% dropped){' - ' + drops if drops else ''}"
+
+# Offset of the MAC payload of an 802.15.4 frame, or the reason to drop it
+# Only data frames are kept, the header length is given by the FCF the same
+# way Scapy does it (the dest PAN id is always there).
+# (None, None) is returned when the payload can't be located.
+def dot15d4_payload(cls, s):
+    if len(s) < 3:
+        return None, 'truncated'
+
+    # FCF (little endian) then the sequence number
+    if s[0] & 0x07 != 1:
+        return None, 'not data'
+
+    # The auxiliary security header is not handled the same way by all Scapy versions
+    if s[0] & 0x08:
+        return None, None
+
+    panidcompress = s[0] & 0x40
+    destmode = (s[1] >> 2) & 0x03
+    srcmode = (s[1] >> 6) & 0x03
+
+    # Reserved or missing destination address: Scapy can't dissect the frame
+    if destmode < 2 or srcmode == 1:
+        return None, 'addressing'
+
+    offset = 3 + 2 + (2 if destmode == 2 else 8)
+    if srcmode != 0:
+        offset += (0 if panidcompress else 2) + (2 if srcmode == 2 else 8)
+
+    # Length of the frame without the FCS
+    end = len(s) - 2 if issubclass(cls, Dot15d4FCS) else len(s)
+    if end <= offset:
+        return None, 'truncated'
+
+    return offset, None
+
+class ZigBeePrefilter(Prefilter):
+    # Rows are only built from decrypted APS data frames:
+    # 802.15.4 data frame / NWK data frame with NWK security
+    def check(self, cls, s):
+        if not issubclass(cls, Dot15d4):
+            return None
+
+        offset, reason = dot15d4_payload(cls, s)
+        if offset is None:
+            return reason
+
+        end = len(s) - 2 if issubclass(cls, Dot15d4FCS) else len(s)
+        if end < offset + 2:
+            return 'truncated'
+
+        # NWK frame control: frame type (2 bits) then the flags
+        if s[offset] & 0x03 != 0:
+            return 'nwk command'
+        if not s[offset + 1] & 0x02:
+            return 'nwk unsecured'
+
+        return None
+
+# IPv6 next headers that can't carry CoAP
+NOT_UDP = [6, 58, 59]
+
+class SixLowPANPrefilter(Prefilter):
+    # Rows are only built from CoAP messages, so from unfragmented IPv6/UDP packets
+    def check(self, cls, s):
+        if not issubclass(cls, Dot15d4):
+            return None
+
+        offset, reason = dot15d4_payload(cls, s)
+        if offset is None:
+            return reason
+
+        dispatch = s[offset]
+
+        # Fragments are not reassembled, Scapy leaves their payload raw
+        if dispatch >> 3 in (0x18, 0x1C):
+            return 'fragment'
+
+        # Uncompressed IPv6: next header at offset 6 of the IPv6 header
+        if dispatch == 0x41:
+            if len(s) > offset + 7 and s[offset + 7] in NOT_UDP:
+                return 'not udp'
+            return None
+
+        # IPHC with the next header inline
+        if dispatch >> 5 == 0x03 and len(s) > offset + 1:
+            tf = (dispatch >> 3) & 0x03
+            nh = (dispatch >> 2) & 0x01
+            if nh:
+                return None
+
+            # Context identifier extension then traffic class and flow label
+            nhOffset = offset + 2 + (s[offset + 1] >> 7) + [4, 3, 1, 0][tf]
+            if len(s) > nhOffset and s[nhOffset] in NOT_UDP:
+                return 'not udp'
+
+        return None
+
+# ATT opcodes converted by BTLEConversion
+ATT_OPCODES = [0x0a, 0x0b, 0x52, 0x1d]
+ADV_ACCESS_ADDR = 0x8E89BED6
+CONNECT_REQ = 0x05
+
+class BTLEPrefilter(Prefilter):
+    # Rows are only built from connect requests and ATT requests/responses
+    def check(self, cls, s):
+        if issubclass(cls, BTLE_RF):
+            s = s[10:]
+        elif not issubclass(cls, BTLE):
+            return None
+
+        # Access address, header (2 bytes), payload then the CRC (3 bytes)
+        if len(s) < 4 + 2 + 3:
+            return 'truncated'
+
+        if int.from_bytes(s[:4], 'little') == ADV_ACCESS_ADDR:
+            return None if s[4] & 0x0f == CONNECT_REQ else 'advertising'
+
+        # LLID 2: start of an L2CAP message
+        if s[4] & 0x03 != 2:
+            return 'not l2cap'
+
+        # L2CAP length and CID (little endian), then the ATT opcode
+        if len(s) < 4 + 2 + 4 + 1 + 3:
+            return 'truncated'
+        if int.from_bytes(s[8:10], 'little') != 4:
+            return 'not att'
+        if s[10] in bleConstants.opCode and s[10] not in ATT_OPCODES:
+            return 'att opcode'
+
+        return None
+
+prefilters = {
+    'ZIGBEE': ZigBeePrefilter,
+    'OS4I': SixLowPANPrefilter,
+    'BTLE': BTLEPrefilter
+}
@@ -0,0 +1,91 @@
+"""replaySniffer
+
+This program replays the frames of captures in place of a sniffer, to measure the hand-off of
+the frames in streaming mode without hardware
+
+Usage:
+    replaySniffer.py [-p <protocol>] [-r <size>] [-l <loop>] [-b <batch>] [-q] <pcap>...
+
+Options:
+    -h, --help                 Print this help message.
+    -p, --protocol protocol    Protocol of the frames (ZIGBEE, OS4I or BTLE). [Default: ZIGBEE]
+    -r, --ring size            Size in bytes of the ring buffer. [Default: 4194304]
+    -l, --loop loop            Number of times the captures are replayed. [Default: 1]
+    -b, --batch batch          Maximum number of frames read at once. [Default: 1000]
+    -q, --queue                Use a queue of the frames instead of the ring buffer.
+
+Example :
+    python -m sniffer.replaySniffer -p ZIGBEE -l 100 tests/zigbee-test3.pcapng
+"""
+
+from docopt import docopt, DocoptExit
+import multiprocessing
+import time
+
+from .sniffers import Sniffer
+from .ring import FrameRing, supported
+from .stream import drain, DEFAULT_FRAMES_QUEUE, RING_POLL
+from .gen_packet import read_raw_frames
+
+class replaySniffer(Sniffer):
+    # options are the name, the captures to replay, the maximum number of frames
+    # (None for all of them), the protocol of the frames and the number of replays
+    def __init__(self, options):
+        name, self.captures, self.nbpkts, self.protocol, self.loop = options
+
+        if name is None:
+            name = 'replay'
+
+        Sniffer.__init__(self, name)
+
+    # The frames keep the timestamps of the captures and are pushed as fast as possible
+    def run(self):
+        packetcount = 0
+        for i in range(self.loop):
+            for capture in self.captures:
+                for linktype, s, t in read_raw_frames(capture):
+                    if self.terminated() or self.nbpkts == packetcount:
+                        return
+
+                    self.push(linktype, s, t)
+                    packetcount += 1
+
+
+if __name__ == '__main__':
+    try:
+        args = docopt(__doc__)
+    except DocoptExit:
+        print(__doc__)
+    else:
+        batchSize = int(args['--batch'])
+        sniffer = replaySniffer([None, args['<pcap>'], None, args['--protocol'], int(args['--loop'])])
+        if not args['--queue'] and not supported():
+            print("[w] Ring buffers are not supported on this platform, the frames go through the queue.")
+            args['--queue'] = True
+
+        if args['--queue']:
+            frames = multiprocessing.Queue(DEFAULT_FRAMES_QUEUE)
+            read = lambda: drain(frames, batchSize, .1)
+        else:
+            frames = FrameRing(int(args['--ring']))
+            read = lambda: frames.pop(batchSize)
+        sniffer.stream(frames)
+
+        # The frames are read until the sniffer is stopped and nothing is left
+        received = 0
+        start = time.time()
+        sniffer.start()
+        while True:
+            alive = sniffer.is_alive()
+            batch = read()
+            received += len(batch)
+            if not batch:
+                if not alive:
+                    break
+                time.sleep(RING_POLL)
+        elapsed = time.time() - start
+
+        pushed, dropped = sniffer.counters()
+        print(f"[i] {pushed} frames pushed, {dropped} dropped, {received} received in {elapsed:.2f}s ({received / elapsed:.0f} frames/s)")
+        if not args['--queue']:
+            frames.close()
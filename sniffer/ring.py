@@ -0,0 +1,150 @@
+import platform
+import struct
+import sys
+
+# Single producer / single consumer ring buffer of frames in shared memory.
+# A sniffer process writes its frames (see Sniffer.push) and the extractor
+# reads them (see stream.FrameExtractor) without lock nor pickling.
+#
+# The shared memory starts with a header of 64-bit counters, the frames are
+# stored after it. Each counter is only written by one side: the producer
+# owns the head (bytes written since the creation) and its drop counters,
+# the consumer owns the tail (bytes read), both are on their own cache line.
+# The producer writes a frame then moves the head, the consumer reads it then
+# moves the tail. This relies on aligned 64-bit stores being atomic (a
+# memoryview of 'Q' writes each counter with a single store) and on stores
+# not being reordered, which holds on x86-64 but not on ARM (e.g. a Raspberry
+# Pi): the rings are only used where supported() is True, the sniffers use
+# the queue elsewhere.
+#
+# A frame is length-prefixed: size of the data, timestamp, RSSI and link
+# type (FRAME_HEADER) followed by the raw bytes. A frame can wrap around the
+# end of the buffer. When there is not enough room the frame is dropped and
+# counted, the producer never waits for the consumer.
+
+# Counters of the header (indexes of 64-bit words)
+HEAD = 0
+PUSHED = 1
+DROPPED = 2
+DROPPED_BYTES = 3
+CAPACITY = 4
+TAIL = 8
+POPPED = 9
+HEADER_SIZE = 128
+
+# size, timestamp, rssi, link type
+FRAME_HEADER = struct.Struct('<IdhH')
+# RSSI of the frames captured without it
+NO_RSSI = -32768
+
+# Size of the ring buffer (data only) if none is given
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+
+# 64-bit processors that don't reorder the stores
+ORDERED_STORES = ('x86_64', 'amd64')
+
+# shared_memory is available since python 3.8, it is only imported when a ring is created
+def supported():
+    return sys.version_info >= (3, 8) and platform.machine().lower() in ORDERED_STORES
+
+class FrameRing(object):
+    # Create a ring of size bytes, or attach to the ring called name
+    def __init__(self, size=DEFAULT_RING_SIZE, name=None):
+        if not supported():
+            raise RuntimeError(f"Ring buffers need python 3.8 and a x86-64 processor, not {platform.machine()}")
+        from multiprocessing import shared_memory
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + size)
+            self.owner = True
+        else:
+            # Only the creator removes the shared memory
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        self.counters = self.shm.buf[:HEADER_SIZE].cast('Q')
+        if self.owner:
+            self.counters[CAPACITY] = size
+        self.capacity = self.counters[CAPACITY]
+        self.data = self.shm.buf[HEADER_SIZE:HEADER_SIZE + self.capacity]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # A ring sent to another process is attached to the same shared memory
+    def __reduce__(self):
+        return FrameRing, (None, self.name)
+
+    def close(self):
+        self.counters.release()
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # Producer side
+    # Write a frame, return False if it is dropped because the ring is full
+    # The RSSI is stored in whole dBm, the sniffers can give a float
+    def push(self, linktype, s, t, rssi=None):
+        frame = FRAME_HEADER.pack(len(s), t, NO_RSSI if rssi is None else int(round(rssi)), linktype) + s
+        head = self.counters[HEAD]
+        if self.capacity - (head - self.counters[TAIL]) < len(frame):
+            self.counters[DROPPED] += 1
+            self.counters[DROPPED_BYTES] += len(s)
+            return False
+
+        self.write(head % self.capacity, frame)
+        # The frame is visible to the consumer once the head is moved
+        self.counters[HEAD] = head + len(frame)
+        self.counters[PUSHED] += 1
+        return True
+
+    def write(self, offset, frame):
+        first = min(len(frame), self.capacity - offset)
+        self.data[offset:offset + first] = frame[:first]
+        if first < len(frame):
+            self.data[:len(frame) - first] = frame[first:]
+
+    # Consumer side
+    # Read up to size frames, return a list of (linktype, raw bytes, timestamp, rssi)
+    def pop(self, size):
+        frames = []
+        tail = self.counters[TAIL]
+        head = self.counters[HEAD]
+        while tail < head and len(frames) < size:
+            length, t, rssi, linktype = FRAME_HEADER.unpack(self.read(tail, FRAME_HEADER.size))
+            s = self.read(tail + FRAME_HEADER.size, length)
+            frames.append((linktype, s, t, None if rssi == NO_RSSI else rssi))
+            tail += FRAME_HEADER.size + length
+
+        # The room of the frames read is given back to the producer at once
+        self.counters[TAIL] = tail
+        self.counters[POPPED] += len(frames)
+        return frames
+
+    def read(self, position, length):
+        offset = position % self.capacity
+        first = min(length, self.capacity - offset)
+        if first == length:
+            return bytes(self.data[offset:offset + length])
+        return bytes(self.data[offset:]) + bytes(self.data[:length - first])
+
+    # Counters, they can be read from any process
+    # Return the number of frames waiting in the ring
+    def depth(self):
+        return self.counters[PUSHED] - self.counters[POPPED]
+
+    # Bytes used by the frames waiting in the ring
+    def used(self):
+        return self.counters[HEAD] - self.counters[TAIL]
+
+    def stats(self):
+        return {
+            'pushed': self.counters[PUSHED],
+            'popped': self.counters[POPPED],
+            'dropped': self.counters[DROPPED],
+            'droppedBytes': self.counters[DROPPED_BYTES],
+            'used': self.used(),
+            'capacity': self.capacity
+        }
@@ -30,7 +30,7 @@ import sys
 import io
 from contextlib import redirect_stdout
 
-from .extmodules.sensniff import SerialInputHandler, PcapDumpOutHandler, Frame
+from .extmodules.sensniff import SerialInputHandler, PcapDumpOutHandler, Frame, stats, NETWORK
 from .sniffers import Sniffer
 
 
@@ -41,6 +41,8 @@ defaults_sensniff = {
 }
 
 class sixlowpanSniffer(Sniffer):
+    protocol = 'OS4I'
+
     def __init__(self, options):
         name, self.device, self.nbpkts, self.channel = options
 
@@ -75,6 +77,7 @@ class sixlowpanSniffer(Sniffer):
                 if len(raw) > 0:
                     t = time.time()
                     frame = Frame(bytearray(raw), t)
+                    self.push(NETWORK, raw, t)
                     for h in out_handlers:
                         h.handle(frame)
                         if stats['Captured'] >= self.nbpkts:
@@ -1,12 +1,22 @@
 import multiprocessing
+import queue
+from .ring import FrameRing
 
 
 class Sniffer(multiprocessing.Process):
+	# Protocol of the rows built from the frames (see gen_packet.PacketGenerator)
+	protocol = None
+
 	def __init__(self, name):
 		super(Sniffer, self).__init__()
 		self.daemon = True
 		self.exit = multiprocessing.Event()
 		self.name = name
+		# Queue or ring of the frames in streaming mode (see stream and ring)
+		self.frames = None
+		# Frames pushed to the queue and frames lost because it was full
+		self.pushed = multiprocessing.Value('L', 0)
+		self.dropped = multiprocessing.Value('L', 0)
 
 	# function to stop the process
 	def terminate(self):
@@ -14,3 +24,33 @@ class Sniffer(multiprocessing.Process):
 
 	def terminated(self):
 		return self.exit.is_set()
+
+	# Streaming mode: the captured frames are also pushed to the queue, or to
+	# a FrameRing shared with the extractor only
+	# Must be called before the sniffer is started
+	def stream(self, frames):
+		self.frames = frames
+
+	# Push a raw frame to the queue in streaming mode
+	# The capture never waits for the consumer: the frame is dropped if the queue is full
+	def push(self, linktype, s, t, rssi=None):
+		if self.frames is None:
+			return
+
+		# The ring counts its frames itself
+		if isinstance(self.frames, FrameRing):
+			self.frames.push(linktype, bytes(s), t, rssi)
+			return
+
+		try:
+			self.frames.put_nowait((self.protocol, linktype, bytes(s), t, rssi))
+			self.pushed.value += 1
+		except queue.Full:
+			self.dropped.value += 1
+
+	# Return the number of frames pushed and dropped in streaming mode
+	def counters(self):
+		if isinstance(self.frames, FrameRing):
+			stats = self.frames.stats()
+			return stats['pushed'], stats['dropped']
+		return self.pushed.value, self.dropped.value
@@ -0,0 +1,259 @@
+import multiprocessing
+import queue
+import heapq
+import logging
+import time
+from itertools import groupby
+from threading import Thread, Event
+from scapy.layers.dot15d4 import conf
+from collections import deque
+from .gen_packet import get_generator, convert_frames, dissect_frame, btle_connection, btle_substitute, DEFAULT_CHUNK_SIZE
+from .extractors.sixlowpanextractor import coapKey
+from .prefilters import prefilters
+
+# Streaming mode: the sniffers push their frames to a queue (see Sniffer.push),
+# a FrameExtractor process converts them to rows with the unified format and
+# a GraphUpdater thread appends the rows to the graphs (see DBController.appendGraph).
+# The queues are bounded: a slow updater fills the queue of the rows, then the
+# extractor stops reading the frames and the sniffers drop the new ones.
+# Instead of the queue of the frames, each sniffer can write to its own
+# FrameRing (see ring) which the extractor polls.
+
+# Maximum number of frames waiting for the extractor
+DEFAULT_FRAMES_QUEUE = 10000
+# Maximum number of batches of rows waiting for the updater
+DEFAULT_ROWS_QUEUE = 100
+# Seconds the extractor waits when the rings are empty
+RING_POLL = .01
+# Seconds a CoAP message can be retransmitted (MAX_TRANSMIT_SPAN of RFC 7252)
+DEFAULT_COAP_WINDOW = 45.
+
+# Number of elements in a queue, None if the platform can't tell (macOS)
+def queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+# Read the elements available in a queue, up to size elements
+# Wait at most timeout seconds for the first one
+def drain(q, size, timeout):
+    try:
+        batch = [q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+
+    while len(batch) < size:
+        try:
+            batch.append(q.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+# Remove the retransmissions of the CoAP messages of a stream of 6LoWPAN frames
+# The last frame of each message (see sixlowpanextractor.cleanCoAPPcap) is held
+# until window seconds have passed since it, then no retransmission can follow.
+# The time is the one of the frames, so a replayed capture gives the same
+# frames as the import of the capture.
+class RetransmissionFilter(object):
+    def __init__(self, window=DEFAULT_COAP_WINDOW):
+        self.window = window
+        # Last frame (first layer, raw bytes, timestamp) of each message
+        self.latest = {}
+
+    def add(self, frames):
+        conf.dot15d4_protocol = 'sixlowpan'
+        for cls, s, t in frames:
+            key = coapKey(dissect_frame(cls, s, t))
+            if key is not None and (key not in self.latest or t >= self.latest[key][2]):
+                self.latest[key] = (cls, s, t)
+
+    # Return the frames held for more than window seconds at the time now
+    # (all of them if None), ordered by timestamp
+    def expire(self, now=None):
+        keys = [key for key, frame in self.latest.items() if now is None or frame[2] < now - self.window]
+        return sorted((self.latest.pop(key) for key in keys), key=lambda frame: frame[2])
+
+class FrameExtractor(multiprocessing.Process):
+    # rings is a list of (protocol, FrameRing), frames can be None if all the sniffers use a ring
+    # coapWindow is the window of the RetransmissionFilter of the 6LoWPAN frames
+    def __init__(self, frames, rows, verbose=False, keys=None, batchSize=1000, timeout=.5, rings=None, coapWindow=DEFAULT_COAP_WINDOW):
+        super(FrameExtractor, self).__init__()
+        self.daemon = True
+        self.exit = multiprocessing.Event()
+        self.name = 'extractor'
+        self.frames = frames
+        self.rings = rings if rings else []
+        self.rows = rows
+        self.verbose = verbose
+        # ZigBee network keys (see gen_packet.PacketGenerator)
+        self.keys = tuple(keys) if keys else None
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.coapWindow = coapWindow
+        # Frames read from the queue (and rings) and rows built from them
+        self.received = multiprocessing.Value('L', 0)
+        self.extracted = multiprocessing.Value('L', 0)
+
+    def terminate(self):
+        self.exit.set()
+
+    def terminated(self):
+        return self.exit.is_set()
+
+    # Convert the frames (protocol, linktype, raw bytes, timestamp, rssi) of a batch
+    # Frames of the same protocol are converted together, in order
+    # The 6LoWPAN frames are converted once their retransmissions are removed
+    def convert(self, batch):
+        self.now = max([self.now] + [f[3] for f in batch])
+
+        rows = []
+        for protocol, frames in groupby(batch, key=lambda f: f[0]):
+            frames = [(conf.l2types.get(linktype, conf.raw_layer), s, t) for p, linktype, s, t, rssi in frames]
+            frames = list(self.prefilters[protocol].filter(frames))
+            if protocol == 'OS4I':
+                self.retransmissions.add(frames)
+            else:
+                rows += self.convert_frames(protocol, frames)
+
+        return rows + self.convert_frames('OS4I', self.retransmissions.expire(self.now))
+
+    # The BTLE rows take the addresses of the last connect request, the ones
+    # received before the first one wait for it like in gen_packet.btle_postprocess
+    def convert_frames(self, protocol, frames):
+        rows = []
+        for row in convert_frames(get_generator(protocol, self.verbose, self.keys), frames):
+            if protocol != 'BTLE':
+                rows.append(row)
+            elif len(row) == 3:
+                self.BTLEAddr = btle_connection(row)
+                rows += [btle_substitute(r, self.BTLEAddr) for r in self.BTLEPending]
+                self.BTLEPending.clear()
+            elif self.BTLEAddr is None:
+                self.BTLEPending.append(row)
+                if len(self.BTLEPending) > DEFAULT_CHUNK_SIZE:
+                    rows.append(self.BTLEPending.popleft())
+            else:
+                rows.append(btle_substitute(row, self.BTLEAddr))
+
+        return rows
+
+    def send(self, rows):
+        if rows:
+            # Wait for the updater, the frames queue fills up meanwhile
+            self.rows.put(rows)
+            self.extracted.value += len(rows)
+
+    # Read the next frames (protocol, linktype, raw bytes, timestamp, rssi) of the rings and queue
+    def read(self):
+        batch = []
+        for protocol, ring in self.rings:
+            batch.extend((protocol,) + frame for frame in ring.pop(self.batchSize))
+
+        # The queue is not waited for while there are rings to poll
+        if self.frames is not None:
+            batch.extend(drain(self.frames, self.batchSize, 0 if self.rings else self.timeout))
+        if not batch and self.rings:
+            time.sleep(RING_POLL)
+
+        return batch
+
+    def run(self):
+        self.prefilters = {protocol: prefilter() for protocol, prefilter in prefilters.items()}
+        self.BTLEAddr = None
+        self.BTLEPending = deque()
+        self.retransmissions = RetransmissionFilter(self.coapWindow)
+        # Timestamp of the last frame received
+        self.now = 0.
+
+        # Once terminated, the frames already in the queue are converted
+        while True:
+            batch = self.read()
+            if not batch:
+                if self.terminated():
+                    break
+                continue
+
+            self.received.value += len(batch)
+            self.send(self.convert(batch))
+
+        # The CoAP messages still held can't be retransmitted anymore, and the
+        # BTLE rows without connect request keep their placeholders
+        self.send(self.convert_frames('OS4I', self.retransmissions.expire()) + list(self.BTLEPending))
+
+        for protocol, prefilter in self.prefilters.items():
+            if prefilter.seen:
+                logging.info(f"[i] Prefilter {protocol}: {prefilter.report()}")
+
+class GraphUpdater(Thread):
+    # deltas is (tdelta1, tdelta2, adelta, maxHops) as given to DBController.appendGraph
+    # Rows are kept lag seconds before they are appended: the rows of several
+    # sniffers are ordered by timestamp within this window, the ones received
+    # later than that are older than the graph and are lost.
+    def __init__(self, dbController, rows, deltas, lag=2., interval=1.):
+        super(GraphUpdater, self).__init__()
+        self.daemon = True
+        self.exit = Event()
+        self.dbc = dbController
+        self.rows = rows
+        self.deltas = deltas
+        self.lag = lag
+        self.interval = interval
+        # Rows waiting for the window to pass, as a heap of (timestamp, n, row)
+        self.pending = []
+        self.received = 0
+        self.appended = 0
+        self.late = 0
+        # Timestamp of the last row in the graph and when it was appended
+        self.watermark = None
+        self.updated = None
+
+    def terminate(self):
+        self.exit.set()
+
+    def terminated(self):
+        return self.exit.is_set()
+
+    # Append the pending rows older than until (all of them if None)
+    def append(self, until=None):
+        rows = []
+        while self.pending and (until is None or self.pending[0][0] <= until):
+            rows.append(heapq.heappop(self.pending)[2])
+        if not rows:
+            return
+
+        self.dbc.appendNodes(rows)
+        marks = self.dbc.appendGraph(rows, *self.deltas)
+        # Nothing is appended to a dl graph without watermark, the rows are lost
+        if 2 not in marks:
+            self.late += len(rows)
+            return
+
+        nb = len([row for row in rows if self.watermark is None or float(row[1]) > self.watermark])
+        self.appended += nb
+        self.late += len(rows) - nb
+        self.watermark = marks.get(2, self.watermark)
+        self.updated = time.time()
+
+    def run(self):
+        self.watermark = self.dbc.watermarks().get(2)
+
+        # Once terminated, all the rows received are appended
+        while True:
+            batches = drain(self.rows, DEFAULT_ROWS_QUEUE, self.interval)
+            if not batches and self.terminated():
+                break
+
+            for rows in batches:
+                for row in rows:
+                    heapq.heappush(self.pending, (float(row[1]), self.received, row))
+                    self.received += 1
+
+            self.append(time.time() - self.lag)
+
+        self.append()
+
+    # Seconds between the last row of the graph and now
+    def delay(self):
+        return None if self.watermark is None else time.time() - self.watermark
@@ -18,12 +18,15 @@ Options:
 from docopt import docopt, DocoptExit
 import logging
 import io
+import time
 from contextlib import redirect_stdout
 
 from killerbee import KillerBee, PcapDumper, DLT_IEEE802_15_4
 from .sniffers import Sniffer
 
 class zigbeeSniffer(Sniffer):
+    protocol = 'ZIGBEE'
+
     def __init__(self, options):
         name, self.device, self.nbpkts, self.channel = options
 
@@ -69,6 +72,7 @@ class zigbeeSniffer(Sniffer):
                         if packet != None:
                             packetcount+=1
                             pd.pcap_dump(packet['bytes'], ant_dbm=packet['dbm'], freq_mhz=rf_freq_mhz)
+                            self.push(DLT_IEEE802_15_4, packet['bytes'], time.time(), packet['dbm'])
                         
             except IOError as e:
                 if e.errno == 32:
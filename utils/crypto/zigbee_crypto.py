@@ -1,6 +1,6 @@
 from scapy.layers.dot15d4 import *
 from scapy.layers.zigbee import *
-from scapy.utils import conf, raw
+from scapy.utils import conf
 
 # This package is very important to convert a string
 # to a byte string with the format b'\xBB\xAA'
@@ -24,105 +24,137 @@ DOT154_CRYPT_ENC_MIC32 = 0x05
 #     UNDERLINE = '\033[4m'
 
 
-def zigbee_decrypt(pktorig, key_net):
+class ZigbeeDecryptor():
     """
-    Decrypts Zigbee packets. Or at least, it should ....
+    Decrypts Zigbee packets secured at the NWK layer (AES-CCM*, MIC-32) with a given key.
+    The key is expanded once and reused for every packet. The nonce, the header
+    and the ciphertext are taken from the captured bytes, the packet is never copied.
     """
-    doMicCheck = False
-
-    #print("\n############################################################\n\n> Starting 4 parameters extraction")
-    
-    pkt = pktorig.copy()
-
-    # Set key in byte format
-    key = unhexlify(key_net)
-
-    # 1. Get MIC using scapy black magic to rebuild the packet correctly
-    pkt.nwk_seclevel = DOT154_CRYPT_ENC_MIC32
-    pkt.data += pkt.mic
-    pkt.mic = pkt.data[-4:]
-    mic = pkt.mic
-    pkt.data = pkt.data[:-4] # Reset pkt after MIC extracted
-
-    # 2. Get ciphertext
-    ciphertext = pkt[ZigbeeSecurityHeader].data
-
-    # 3. Get nonce using two ways. The zbdecrypt way seems to be the right one. The second is another found on another project
-    using_zb_nonce = True
-    if using_zb_nonce:
-        extended_src = pkt[ZigbeeSecurityHeader].source
-        if extended_src is None:
+    def __init__(self, key_net):
+        # Set key in byte format
+        self.key = unhexlify(key_net) if isinstance(key_net, str) else bytes(key_net)
+        self.cipher = AES.new(self.key, AES.MODE_ECB)
+
+    # Return (header, ciphertext, mic, nonce) from the raw bytes of the packet
+    # or None if the packet can't be decrypted
+    @staticmethod
+    def split(pkt):
+        nwk = pkt[ZigbeeNWK].original
+        sec = pkt[ZigbeeSecurityHeader].original
+        if not nwk or not sec:
+            return None
+
+        # Security control: the security level is not sent over the air,
+        # it is always ENC-MIC-32 for the NWK layer
+        control = (sec[0] & 0xf8) | DOT154_CRYPT_ENC_MIC32
+        extended_nonce = sec[0] & 0x20
+        key_type = (sec[0] >> 3) & 0x03
+        if not extended_nonce:
+            return None
+
+        # control (1), frame counter (4), source (8), key sequence number (0/1)
+        length = 13 + (1 if key_type == 1 else 0)
+        if len(sec) < length + 4:
+            return None
+
+        # The header is the whole NWK frame before the ciphertext
+        offset = len(nwk) - len(sec)
+        header = nwk[:offset] + bytes([control]) + sec[1:length]
+        ciphertext, mic = sec[length:-4], sec[-4:]
+        nonce = sec[5:13] + sec[1:5] + bytes([control])
+
+        return header, ciphertext, mic, nonce
+
+    # AES-CCM with a 4 bytes MIC and a 2 bytes length field (13 bytes nonce)
+    # Return the plaintext and the result of the MIC check
+    def ccm_decrypt(self, header, ciphertext, mic, nonce):
+        # Key stream: A_i = flags | nonce | counter, S_0 encrypts the MIC
+        blocks = (len(ciphertext) + 15) // 16
+        counters = b''.join(b'\x01' + nonce + i.to_bytes(2, 'big') for i in range(blocks + 1))
+        stream = self.cipher.encrypt(counters)
+        plaintext = bytes(c ^ s for c, s in zip(ciphertext, stream[16:]))
+
+        # CBC-MAC over B_0, the header (with its length) and the plaintext
+        auth = len(header).to_bytes(2, 'big') + header
+        auth += bytes(-len(auth) % 16)
+        message = plaintext + bytes(-len(plaintext) % 16)
+        b0 = bytes([0x49]) + nonce + len(plaintext).to_bytes(2, 'big')
+        data = b0 + auth + message
+
+        tag = 0
+        for i in range(0, len(data), 16):
+            block = tag ^ int.from_bytes(data[i:i+16], 'big')
+            tag = int.from_bytes(self.cipher.encrypt(block.to_bytes(16, 'big')), 'big')
+
+        expected = bytes(t ^ s for t, s in zip(tag.to_bytes(16, 'big')[:4], stream[:4]))
+
+        return plaintext, expected == mic
+
+    def decrypt(self, pkt):
+        """
+        Returns the decrypted payload (ZigbeeAppDataPayload or ZigbeeNWKCommandPayload),
+        the raw payload if the MIC is wrong, None if the packet can't be decrypted.
+        """
+        parts = self.split(pkt)
+        if parts is None:
             return None
-        nonce = struct.pack('Q',*struct.unpack('>Q', extended_src.to_bytes(8, byteorder="big"))) + struct.pack('I', pkt[ZigbeeSecurityHeader].fc) + struct.pack('B', bytes(pkt[ZigbeeSecurityHeader])[0])
-        # sys.byteorder MUST BE byteorder="big"
-    else:
-        # Get NONCE : create NONCE (for crypt) and zigbeeData (for MIC) according to packet type ----------> Whatever that means
-        sec_ctrl_byte = str(pkt[ZigbeeSecurityHeader])[0]
-        if ZigbeeAppDataPayload in pkt:
-            nonce = str(struct.pack('L',pkt[ZigbeeNWK].ext_src))+str(struct.pack('I',pkt[ZigbeeSecurityHeader].fc)) + sec_ctrl_byte
-        else:
-            nonce = str(struct.pack('L',pkt[ZigbeeSecurityHeader].source))+str(struct.pack('I',pkt[ZigbeeSecurityHeader].fc)) + sec_ctrl_byte
-
-    # 4. Get ZigbeeData, aka the content of the ZigbeeNWK header.
-    data_len = len(ciphertext) + len(mic)
-    if ZigbeeAppDataPayload in pkt:
-        if data_len > 0:
-            header = bytes(pkt[ZigbeeAppDataPayload])[:-data_len]
-        else:
-            header = bytes(pkt[ZigbeeAppDataPayload])
-    else:
-        if data_len > 0:
-            header = bytes(pkt[ZigbeeNWK])[:-data_len]
-        else:
-            header = bytes(pkt[ZigbeeNWK])
-
-    # # Print the 4 extracted parameters
-    # For debug purpose
-    
-    # print(key)
-    # hexdump(key)
-    # print("\n--------------------\n\n" + bcolors.FAIL + "1. NONCE : ?????????? Most likely the cause of the issue. Length is good (13, function says 7 to 13) but probably bad content. Changing little/big endian doesn't correct the decryption.\n" + bcolors.ENDC)
-    # print(f"Nonce : {nonce} ; Length : {len(nonce)}")
-
-    # print("\n--------------------\n\n" + bcolors.OKGREEN + "2. MIC : validated\n" + bcolors.ENDC)
-    # print(f"MIC : {pkt.mic} ; Length : {len(pkt.mic)}")
-
-    # print("\n--------------------\n\n" + bcolors.WARNING + "3. Ciphertext : More or less validated. MIC isn't part of what's considered 'Ciphertext' which makes sense.\n" + bcolors.ENDC)
-    # print(f"Ciphertext : {ciphertext} ; Length : {len(ciphertext)}")
-    # hexdump(ciphertext)
-
-    # print("\n--------------------\n\n" + bcolors.OKGREEN + "4. ZigbeeData : Validated (ends right before the part that is encrypted)\n" + bcolors.ENDC)
-    # print(f"ZigbeeData : {header} ; Length : {len(header)}")
-    # hexdump(header)
-
-
-    ###########################
-    # Decryption
-    cipher = AES.new(key, AES.MODE_CCM, nonce=nonce, mac_len=4) # Create cipher
-    cipher.update(header) # ???? It doesn't change anything, but it was in the original code.
-    payload = cipher.decrypt(ciphertext) # Decrypt the ciphertext
-    
-    # Verify MIC
-    try:
-        cipher.verify(mic)
-        micCheck = True
-    except ValueError:
-        micCheck = False
-
-    # print("\n\n############################################################\n" + bcolors.HEADER + "Decrypted packet :\n" + bcolors.ENDC)
-    # hexdump(text)
 
+        payload, micCheck = self.ccm_decrypt(*parts)
+
+        return decode_payload(pkt, payload, micCheck)
+
+# Dissect the decrypted payload according to the NWK frame type
+# The payload is left raw if the MIC is wrong
+def decode_payload(pkt, payload, micCheck):
     frametype = pkt[ZigbeeNWK].frametype
-    if frametype == 0 and micCheck == 1:
+    if frametype == 0 and micCheck:
         payload = ZigbeeAppDataPayload(payload)
-    elif frametype == 1 and micCheck == 1:
+    elif frametype == 1 and micCheck:
         payload = ZigbeeNWKCommandPayload(payload)
-    else:
-        payload = raw(payload)
-
-    if doMicCheck == False:
-        return payload
-    else:
-        if micCheck == 1: return (payload, True)
-        else:             return (payload, False)
-            
+
+    return payload
+
+class ZigbeeKeyRing():
+    """
+    Decrypts Zigbee packets from several networks (or with rotating keys) with a list of keys.
+    Each key is tried until the MIC is verified, then the key is remembered for the
+    (PAN id, extended source, key sequence number) of the packet, so next packets of
+    the same source are decrypted with a single key.
+    """
+    def __init__(self, keys):
+        self.decryptors = [ZigbeeDecryptor(key) for key in keys]
+        self.cache = {}
+
+    def decrypt(self, pkt):
+        """
+        Same results as ZigbeeDecryptor.decrypt with the first key that verifies the MIC.
+        """
+        parts = ZigbeeDecryptor.split(pkt)
+        if parts is None:
+            return None
+
+        sec = pkt[ZigbeeSecurityHeader]
+        source = (getattr(pkt, 'dest_panid', None), sec.source, sec.getfieldval('key_seqnum'))
+
+        # The key which worked for this source is tried first
+        first = self.cache.get(source, 0)
+        order = [first] + [i for i in range(len(self.decryptors)) if i != first]
+
+        failed = None
+        for i in order:
+            payload, micCheck = self.decryptors[i].ccm_decrypt(*parts)
+            if micCheck:
+                self.cache[source] = i
+                return decode_payload(pkt, payload, micCheck)
+
+            if failed is None:
+                failed = payload
+
+        return decode_payload(pkt, failed, False)
+
+def zigbee_decrypt(pktorig, key_net):
+    """
+    Decrypts Zigbee packets.
+    Creates a decryptor for each call, use a ZigbeeDecryptor to decrypt several packets with the same key.
+    """
+    return ZigbeeDecryptor(key_net).decrypt(pktorig)
@@ -1,7 +1,7 @@
 import matplotlib
 import matplotlib.pyplot as plt
 
-from utils.utils import compare2arrays
+from utils.utils import compare2arrays, row_key
 import copy
 
 def get_trans_graph_without_controller(tab):
@@ -128,4 +128,86 @@ def plot_controller_delta(expectedResult, samples, plot:bool=False, debug=None):
 		output = 'tests/controller-plot'
 		title = 'Delta used to set nodes as controller'
 		xlabel = 'delta (second)'
-		plot_preicison_recall(x_axis, y_axis_precision, y_axis_recall, xlabel, title, output)
\ No newline at end of file
+		plot_preicison_recall(x_axis, y_axis_precision, y_axis_recall, xlabel, title, output)
+
+# Same results as plot_controller_delta from a single run of the transport graph
+# thresholds is a list of (row, delay) where row is returned by transGraph for
+# any delta greater than delay (see DBController.controllerThresholds)
+# The rows are added in order of delay, so the precision and recall of all
+# deltas are computed in a single pass
+# Return the list of (delta, precision, recall)
+def calibrate_controller_delta(expectedResult, thresholds, deltas, plot:bool=False, debug=None):
+	er = copy.deepcopy(expectedResult)
+
+	if not debug is None:
+		with open(debug, 'a') as outputFile:
+			outputFile.write(f"[d] - before modifications\n{expectedResult}\n")
+			outputFile.write(f"[d] - after modifications\n{er}\n")
+			outputFile.write(f"[d] - Thresholds\n{thresholds}\n\n")
+
+	# Number of expected rows for each value
+	expected = {}
+	for line in er:
+		key = row_key(line)
+		expected[key] = expected.get(key, 0) + 1
+
+	thresholds = sorted(thresholds, key=lambda x: x[1])
+	found = set()
+	truePos = 0
+	falsePos = 0
+	falseNeg = len(er)
+	i = 0
+
+	x_axis = []           # delta
+	y_axis_precision = [] # Precision rate
+	y_axis_recall = []    # Recall rate
+	for tdelta in sorted(deltas):
+		# Rows returned from this delta
+		while i < len(thresholds) and thresholds[i][1] < tdelta:
+			key = row_key(thresholds[i][0])
+			if key in expected:
+				truePos += 1
+				if key not in found:
+					found.add(key)
+					falseNeg -= expected[key]
+			else:
+				falsePos += 1
+			i += 1
+
+		x_axis.append(tdelta)
+		y_axis_precision.append(truePos / (truePos + falsePos) if truePos + falsePos else 0.)
+		y_axis_recall.append(truePos / (truePos + falseNeg) if truePos + falseNeg else 0.)
+
+	if plot:
+		output = 'tests/controller-plot'
+		title = 'Delta used to set nodes as controller'
+		xlabel = 'delta (second)'
+		plot_preicison_recall(x_axis, y_axis_precision, y_axis_recall, xlabel, title, output)
+
+	return list(zip(x_axis, y_axis_precision, y_axis_recall))
+
+# Plot the precision and recall of each delta of a grid search, the other
+# deltas being set to the values of the best combination (best F-score)
+# table is a list of (tdelta1, tdelta2, adelta, precision, recall)
+# Return the best combination
+def plot_grid_search(table, plot:bool=False):
+	def fscore(line):
+		precision, recall = line[3], line[4]
+		return 2 * precision * recall / (precision + recall) if precision + recall else 0.
+
+	best = max(table, key=fscore)
+
+	if plot:
+		axes = [
+			(0, 'Delta for transport graph part 1', 'Precision and recall for tdelta1', 'tests/plot-tdelta1.png'),
+			(1, 'Delta for transport graph part 2', 'Precision and recall for tdelta2', 'tests/plot-tdelta2.png'),
+			(2, 'Delta for application graph', 'Precision and recall for adelta', 'tests/plot-adelta.png')
+		]
+		for i, xlabel, title, output in axes:
+			lines = sorted((line for line in table if all(line[j] == best[j] for j in range(3) if j != i)), key=lambda line: line[i])
+			x_axis = [line[i] for line in lines]
+			y_axis_precision = [line[3] for line in lines]
+			y_axis_recall = [line[4] for line in lines]
+			plot_preicison_recall(x_axis, y_axis_precision, y_axis_recall, xlabel, title, output)
+
+	return best
\ No newline at end of file
@@ -128,51 +128,29 @@ def convert_str_to_array(tab):
 
 
 
-# This function compares two arrays and returns two values
-# the result of A - B and the result of B - A
-# In other words, the function returns the missing and extra elements of B compare to A
+# Canonical value of a row of results: the order of the addresses and roles
+# of a field doesn't matter, so each list is a frozenset. The edge type (a
+# string) is kept as is. Two rows are equal for compare2arrays if they
+# have the same key.
+def row_key(line):
+    return tuple(field if isinstance(field, str) else frozenset(field) for field in line)
+
+# This function compares two arrays and returns three values
+# the result of A - B, the result of B - A and the elements of B in A
+# In other words, the function returns the missing, extra and found elements of B compare to A
+# The rows are compared with their keys in linear time, duplicated rows are kept
 def compare2arrays(arrayA, arrayB):
+    keysA = [row_key(line) for line in arrayA]
+    keysB = [row_key(line) for line in arrayB]
+    setA = set(keysA)
+    setB = set(keysB)
 
-    falseNeg = []
-    falsePos = []
-    truePos = []
-
-    # This loop returns missing elements in arrayB according
-    # to the arrayA
-    for lineA in arrayA:
-        isIn = False
-        # print(f"lineA : {lineA} : {len(lineA)}")
-        for lineB in arrayB:
-            # print(f"lineB: {lineB} : {len(lineB)}")
-            count = 0
-            for i in range(len(lineA)):
-                if set(lineB[i]) == set(lineA[i]):
-                    count+=1
-
-            if count == len(lineA):
-                isIn = True
-                break
-            
-        if not isIn:
-            falseNeg.append(lineA)
-
-    # This loop returns extra elements in arrayB according
-    # to the arrayA
-    for lineB in arrayB:
-        notIn = True
-        for lineA in arrayA:
-            count = 0
-            for i in range(len(lineA)):
-                if set(lineB[i]) == set(lineA[i]):
-                    count+=1
-
-            if count == len(lineB):
-                notIn = False
-
-        if notIn:
-           falsePos.append(lineB)
-        else:
-            truePos.append(lineB)
+    # Missing elements in arrayB according to the arrayA
+    falseNeg = [line for line, key in zip(arrayA, keysA) if key not in setB]
+
+    # Extra elements in arrayB according to the arrayA
+    falsePos = [line for line, key in zip(arrayB, keysB) if key not in setA]
+    truePos = [line for line, key in zip(arrayB, keysB) if key in setA]
 
     return falseNeg, falsePos, truePos
 